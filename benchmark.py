@@ -0,0 +1,558 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections.abc import Callable, Iterable, Iterator
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Any
+
+import httpx
+import numpy as np
+import pandas as pd
+
+import pypi_stand_in
+import release_cache
+import update_cache
+import update_consumer_stats
+import update_dataset
+import update_stats
+import utils
+
+_LOGGER = logging.getLogger(__name__)
+# synthetic data is generated up to that date for results to be comparable
+_END = date(2023, 1, 1)
+# fields of a result that tell which run it is, the others are measures
+_RUN_KEYS = ("stage", "scale", "run")
+# measures where more means worse, compared against the baseline
+_REGRESSION_KEYS = ("seconds", "cpu_seconds", "peak_rss_mb", "p50_ms", "p99_ms")
+_PLATFORMS = (
+    "manylinux1_x86_64",
+    "manylinux1_i686",
+    "manylinux2010_x86_64",
+    "manylinux_2_17_x86_64.manylinux2014_x86_64",
+    "manylinux_2_17_aarch64.manylinux2014_aarch64",
+    "manylinux_2_17_ppc64le.manylinux2014_ppc64le",
+    "manylinux_2_17_s390x.manylinux2014_s390x",
+    "manylinux_2_24_armv7l",
+    "manylinux_2_28_x86_64",
+    "manylinux_2_28_aarch64",
+)
+# (value, weight) of consumer data columns, roughly what BigQuery returns
+_CONSUMER_COLUMNS = {
+    "cpu": (
+        ("x86_64", 80),
+        ("aarch64", 10),
+        ("i686", 4),
+        ("armv7l", 3),
+        ("ppc64le", 1),
+        ("s390x", 1),
+        ("armv6l", 1),
+    ),
+    "python_version": tuple((f"3.{i}", 10) for i in range(5, utils.IMPL_CP3_LAST + 1))
+    + (("2.7", 5), ("3.4", 1)),
+    "pip_version": tuple(
+        (f"{major}.{minor}", 4) for major in range(19, 23) for minor in range(4)
+    )
+    + (("9.0", 3), ("8.1", 1)),
+    "glibc_version": tuple(
+        (f"2.{minor}", 5)
+        for minor in (5, 12, 17, 19, 23, 24, 26, 27, 28, 31, 34, 35, 36)
+    ),
+}
+
+
+class _MemoryReleaseCache(release_cache.ReleaseCache):
+    # keeps the benchmark away from the real cache and from disk I/O
+
+    def __init__(self) -> None:
+        self._infos: dict[str, str] = {}
+
+    def get_etag(self, package: str) -> str | None:
+        info = self._infos.get(package)
+        return None if info is None else str(json.loads(info)["etag"])
+
+    def put(self, package: str, info: dict[str, Any]) -> None:
+        self._infos[package] = json.dumps(info)
+
+    def move(self, package: str, package_new_name: str) -> None:
+        self._infos[package_new_name] = self._infos.pop(package)
+
+    def get_stamps(self, packages: Iterable[str]) -> dict[str, str]:
+        return {p: str(hash(self._infos[p])) for p in packages if p in self._infos}
+
+    def iter_raw(self, packages: Iterable[str]) -> Iterator[tuple[str, str]]:
+        for package in packages:
+            if package in self._infos:
+                yield package, self._infos[package]
+
+
+def _serve(options: pypi_stand_in.StandInOptions, queue: Any) -> None:
+    with pypi_stand_in.StandInServer(("127.0.0.1", 0), options) as server:
+        queue.put(server.index_url)
+        server.serve_forever()
+
+
+def _get_server_stats(index_url: str) -> dict[str, int]:
+    response = httpx.get(index_url.removesuffix("/pypi") + "/stats")
+    response.raise_for_status()
+    return dict(response.json())
+
+
+async def _fetch(
+    index_url: str,
+    packages: list[str],
+    cache: release_cache.ReleaseCache,
+    concurrency: int,
+    http2: bool,
+) -> dict[str, update_cache.PackageStatus]:
+    # the first pass of update_cache.update, without the scheduling and
+    # the negative cache which would skip packages
+    limiter = update_cache._Limiter(concurrency)
+    async with update_cache._create_client(concurrency, http2) as client:
+        return await update_cache._package_update_all(
+            client, limiter, cache, packages, concurrency, index_url
+        )
+
+
+def _run_fetch(
+    index_url: str,
+    packages: list[str],
+    cache: release_cache.ReleaseCache,
+    concurrency: int,
+    http2: bool,
+) -> dict[str, Any]:
+    stats_before = _get_server_stats(index_url)
+    start = time.perf_counter()
+    results = asyncio.run(_fetch(index_url, packages, cache, concurrency, http2))
+    seconds = time.perf_counter() - start
+    stats_after = _get_server_stats(index_url)
+    responses = {
+        status: count - stats_before.get(status, 0)
+        for status, count in stats_after.items()
+        if count != stats_before.get(status, 0)
+    }
+    requests = sum(responses.values())
+    latencies = sorted(result.elapsed for result in results.values())
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "packages": len(packages),
+        "requests": requests,
+        "responses": responses,
+        "errors": sum(r.status == update_cache.Status.ERROR for r in results.values()),
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(requests / seconds, 1),
+        "p50_ms": round(percentiles[49] * 1000, 1),
+        "p99_ms": round(percentiles[98] * 1000, 1),
+    }
+
+
+def fetch(
+    options: pypi_stand_in.StandInOptions,
+    package_count: int,
+    scales: list[int],
+    concurrency: int,
+    http2: bool,
+) -> list[dict[str, Any]]:
+    # the stand-in runs in its own process so that it doesn't compete with
+    # the client for the GIL
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    server = context.Process(target=_serve, args=(options, queue), daemon=True)
+    server.start()
+    try:
+        index_url = queue.get(timeout=30)
+        results = []
+        for scale in scales:
+            packages = [f"package-{i:06d}" for i in range(package_count * scale)]
+            cache = _MemoryReleaseCache()
+            # cold: everything is downloaded, warm: everything is a 304
+            for run in ("cold", "warm"):
+                result = {"scale": scale, "run": run}
+                result.update(
+                    _run_fetch(index_url, packages, cache, concurrency, http2)
+                )
+                _LOGGER.info(json.dumps(result))
+                results.append(result)
+        return results
+    finally:
+        server.terminate()
+        server.join()
+
+
+def _use_root(root: Path) -> None:
+    # the stages read and write under the paths of utils, move them to root
+    for name, value in list(vars(utils).items()):
+        if (
+            name.endswith("_PATH")
+            and name != "ROOT_PATH"
+            and isinstance(value, Path)
+            and value.is_relative_to(utils.ROOT_PATH)
+        ):
+            setattr(utils, name, root / value.relative_to(utils.ROOT_PATH))
+    utils.ROOT_PATH = root
+
+
+def _synthetic_releases(
+    rng: random.Random, package: str, first: date, last: date
+) -> dict[str, tuple[str, list[str]]]:
+    # release history as filtered by update_cache: manylinux wheels only
+    name = package.replace("-", "_")
+    days = (last - first).days
+    releases = {}
+    for i in range(rng.randint(1, 40)):
+        upload_date = first + timedelta(days=rng.randint(0, days))
+        lowest = rng.randint(utils.IMPL_CP3_FIRST, utils.IMPL_CP3_LAST)
+        highest = rng.randint(lowest, utils.IMPL_CP3_LAST)
+        tags = [f"cp3{python}-cp3{python}" for python in range(lowest, highest + 1)]
+        if rng.random() < 0.1:
+            tags = [f"cp3{lowest}-abi3"]
+        platforms = rng.sample(_PLATFORMS, rng.randint(1, 6))
+        releases[f"{i // 10}.{i % 10}.0"] = (
+            upload_date.isoformat(),
+            [
+                f"{name}-{i // 10}.{i % 10}.0-{tag}-{platform}.whl"
+                for tag in tags
+                for platform in platforms
+            ],
+        )
+    return releases
+
+
+def _generate_cache(packages: list[str], start: date, end: date, seed: int) -> None:
+    with release_cache.open_cache() as cache:
+        for package in packages:
+            rng = random.Random(f"{seed}:{package}")
+            first = start - timedelta(days=rng.randint(0, 3 * 365))
+            releases = _synthetic_releases(rng, package, first, end)
+            info = {
+                "etag": f"{seed}:{package}",
+                "releases": release_cache.summarize(package, releases),
+            }
+            cache.put(package, info)
+
+
+def _generate_consumer_data(
+    path: Path, start: date, end: date, rows_per_day: int, seed: int
+) -> None:
+    # one CSV per day, from the start of the first window
+    rng = np.random.default_rng(seed)
+    day = start - utils.CONSUMER_WINDOW_SIZE
+    while day < end:
+        folder = path / day.strftime("%Y") / day.strftime("%m")
+        folder.mkdir(parents=True, exist_ok=True)
+        df = pd.DataFrame({"cpu": [], "num_downloads": []})
+        for column, choices in _CONSUMER_COLUMNS.items():
+            values = np.array([value for value, _ in choices])
+            weights = np.array([weight for _, weight in choices], dtype=np.float64)
+            df[column] = rng.choice(values, rows_per_day, p=weights / weights.sum())
+        df["num_downloads"] = rng.integers(1, 1_000_000, rows_per_day)
+        df.to_csv(folder / day.strftime("%d.csv"), index=False)
+        day += timedelta(days=1)
+
+
+def _dataset_stage(
+    packages: list[str], start: date, end: date, jobs: int
+) -> Callable[[], Any]:
+    cache = release_cache.open_cache()
+    return lambda: update_dataset.update(packages, cache, jobs)
+
+
+def _stats_stage(
+    packages: list[str], start: date, end: date, jobs: int
+) -> Callable[[], Any]:
+    with release_cache.open_cache() as cache:
+        _, rows = update_dataset.update(packages, cache, jobs)
+    return lambda: update_stats.update(rows, start, end, utils.PRODUCER_DATA_PATH)
+
+
+def _consumer_stats_stage(
+    packages: list[str], start: date, end: date, jobs: int
+) -> Callable[[], Any]:
+    path = utils.ROOT_PATH / "consumer_data"
+    return lambda: update_consumer_stats.update(
+        path, start, end, utils.CONSUMER_DATA_PATH
+    )
+
+
+def _consumer_stats_warm_stage(
+    packages: list[str], start: date, end: date, jobs: int
+) -> Callable[[], Any]:
+    # the output stored by the previous stage would be reused as is, what's
+    # measured is the update of the rolling state it saved
+    shutil.rmtree(utils.ARTIFACTS_PATH, ignore_errors=True)
+    return _consumer_stats_stage(packages, start, end, jobs)
+
+
+# in order, "-warm" stages run again with what the previous one stored,
+# "-artifact" ones reuse the output of the previous one
+_STAGES = {
+    "dataset": _dataset_stage,
+    "dataset-warm": _dataset_stage,
+    "stats": _stats_stage,
+    "consumer-stats": _consumer_stats_stage,
+    "consumer-stats-warm": _consumer_stats_warm_stage,
+    "consumer-stats-artifact": _consumer_stats_stage,
+}
+
+
+def _run_stage(
+    root: Path,
+    stage: str,
+    packages: list[str],
+    start: date,
+    end: date,
+    jobs: int,
+    queue: Any,
+) -> None:
+    # runs in a fresh process, so that the peak memory is the one of the stage
+    _use_root(root)
+    utils.BUILD_PATH.mkdir(exist_ok=True)
+    run = _STAGES[stage](packages, start, end, jobs)
+    start_cpu = time.process_time()
+    start_time = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start_time
+    cpu_seconds = time.process_time() - start_cpu
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_seconds += children.ru_utime + children.ru_stime
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak_rss //= 1024  # bytes instead of KiB
+    queue.put(
+        {
+            "seconds": round(seconds, 3),
+            "cpu_seconds": round(cpu_seconds, 3),
+            "peak_rss_mb": round(peak_rss / 1024, 1),
+        }
+    )
+
+
+def stages(
+    package_count: int,
+    scales: list[int],
+    days: int,
+    consumer_rows: int,
+    jobs: int,
+    seed: int,
+) -> list[dict[str, Any]]:
+    # each scale multiplies the number of packages and consumer rows per day
+    end = _END
+    start = end - timedelta(days=days)
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for scale in scales:
+        with tempfile.TemporaryDirectory(prefix="benchmark-") as tmp:
+            root = Path(tmp)
+            _use_root(root)
+            utils.CACHE_PATH.mkdir()
+            packages = [f"package-{i:06d}" for i in range(package_count * scale)]
+            _LOGGER.info(f"scale {scale}: generating synthetic data")
+            _generate_cache(packages, start, end, seed)
+            _generate_consumer_data(
+                root / "consumer_data", start, end, consumer_rows * scale, seed
+            )
+            for stage in _STAGES:
+                queue = context.Queue()
+                process = context.Process(
+                    target=_run_stage,
+                    args=(root, stage, packages, start, end, jobs, queue),
+                )
+                process.start()
+                result: dict[str, Any] = {"stage": stage, "scale": scale}
+                result.update(queue.get())
+                process.join()
+                _LOGGER.info(json.dumps(result))
+                results.append(result)
+    return results
+
+
+def _get_run_key(result: dict[str, Any]) -> tuple[Any, ...]:
+    return tuple(result.get(key) for key in _RUN_KEYS)
+
+
+def _check_baseline(
+    baseline: dict[str, Any],
+    parameters: dict[str, Any],
+    results: list[dict[str, Any]],
+    threshold: float,
+) -> list[str]:
+    # measures above the baseline by more than threshold
+    if baseline["parameters"] != parameters:
+        _LOGGER.warning("baseline parameters differ, not comparing")
+        return []
+    reference = {_get_run_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        base = reference.get(_get_run_key(result))
+        if base is None:
+            continue
+        for key in _REGRESSION_KEYS:
+            if (
+                key in result
+                and key in base
+                and result[key] > base[key] * (1.0 + threshold)
+            ):
+                name = "/".join(str(k) for k in _get_run_key(result) if k is not None)
+                regressions.append(f"{name}: {key} {base[key]} -> {result[key]}")
+    return regressions
+
+
+def _print_table(results: list[dict[str, Any]]) -> None:
+    columns = [key for key, value in results[0].items() if not isinstance(value, dict)]
+    widths = [max(len(c), *(len(str(r[c])) for r in results)) for c in columns]
+    print("  ".join(c.rjust(w) for c, w in zip(columns, widths)))
+    for result in results:
+        print("  ".join(str(result[c]).rjust(w) for c, w in zip(columns, widths)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark manylinux-timeline",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    fetch_parser = subparsers.add_parser(
+        "fetch", help="cache update against a local PyPI stand-in"
+    )
+    fetch_parser.add_argument(
+        "--packages", default=100, type=int, help="number of packages at scale 1"
+    )
+    fetch_parser.add_argument(
+        "--scales", default=[1, 10, 100], type=int, nargs="+", help="scales to run"
+    )
+    fetch_parser.add_argument(
+        "--fetch-concurrency",
+        default=32,
+        type=int,
+        help="maximum number of concurrent requests",
+    )
+    fetch_parser.add_argument("--http2", action="store_true", help="use HTTP/2")
+    fetch_parser.add_argument(
+        "--latency", default=0.05, type=float, help="seconds added to each response"
+    )
+    fetch_parser.add_argument(
+        "--jitter", default=0.05, type=float, help="random seconds added to latency"
+    )
+    fetch_parser.add_argument(
+        "--removed-ratio", default=0.01, type=float, help="ratio of 404 packages"
+    )
+    fetch_parser.add_argument(
+        "--moved-ratio", default=0.01, type=float, help="ratio of 301 packages"
+    )
+    fetch_parser.add_argument(
+        "--throttle-ratio", default=0.0, type=float, help="ratio of 429 responses"
+    )
+    fetch_parser.add_argument("--seed", default=0, type=int)
+    stages_parser = subparsers.add_parser(
+        "stages", help="dataset and statistics stages on synthetic data"
+    )
+    stages_parser.add_argument(
+        "--packages", default=1000, type=int, help="number of packages at scale 1"
+    )
+    stages_parser.add_argument(
+        "--scales", default=[1, 10], type=int, nargs="+", help="scales to run"
+    )
+    stages_parser.add_argument(
+        "--days", default=730, type=int, help="number of days in the date range"
+    )
+    stages_parser.add_argument(
+        "--consumer-rows",
+        default=1600,
+        type=int,
+        help="number of consumer data rows per day at scale 1",
+    )
+    stages_parser.add_argument(
+        "-j", "--jobs", default=1, type=int, help="number of processes for dataset"
+    )
+    stages_parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("-o", "--output", type=Path, help="write results as JSON")
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        help="baseline to compare results with, "
+        "defaults to cache/benchmark-<command>.json",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="save results as the new baseline instead of comparing them",
+    )
+    parser.add_argument(
+        "--threshold",
+        default=0.2,
+        type=float,
+        help="relative increase of a measure reported as a regression",
+    )
+    parser.add_argument(
+        "-v", "--verbosity", action="count", help="increase output verbosity"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=30 - 10 * min(args.verbosity or 0, 2))
+    if (args.verbosity or 0) < 2:
+        # httpx logs every request at INFO level
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+    if not args.verbosity:
+        # the stand-in removes packages on purpose
+        logging.getLogger("update_cache").setLevel(logging.ERROR)
+    # the parameters of the run, results are only compared with a baseline
+    # obtained with the same ones
+    parameters = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in {"output", "baseline", "save_baseline", "threshold", "verbosity"}
+    }
+    baseline_path = args.baseline
+    if baseline_path is None:
+        baseline_path = utils.CACHE_PATH / f"benchmark-{args.command}.json"
+    if args.command == "fetch":
+        results = fetch(
+            pypi_stand_in.StandInOptions(
+                latency=args.latency,
+                jitter=args.jitter,
+                removed_ratio=args.removed_ratio,
+                moved_ratio=args.moved_ratio,
+                throttle_ratio=args.throttle_ratio,
+                retry_after=0.0,
+                seed=args.seed,
+            ),
+            args.packages,
+            args.scales,
+            args.fetch_concurrency,
+            args.http2,
+        )
+    else:
+        results = stages(
+            args.packages,
+            args.scales,
+            args.days,
+            args.consumer_rows,
+            args.jobs,
+            args.seed,
+        )
+    _print_table(results)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump({"parameters": parameters, "results": results}, f, indent=2)
+        _LOGGER.warning(f"baseline saved to {baseline_path}")
+    elif baseline_path.exists():
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = _check_baseline(baseline, parameters, results, args.threshold)
+        for regression in regressions:
+            _LOGGER.error(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
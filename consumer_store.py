@@ -0,0 +1,164 @@
+import logging
+from datetime import date, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from packaging.version import InvalidVersion, Version
+
+import metrics
+import utils
+
+_LOGGER = logging.getLogger(__name__)
+# bump when the layout of the monthly files or the normalisation changes
+_STORE_VERSION = 1
+_CATEGORICAL_COLUMNS = ("cpu", "python_version", "pip_version", "glibc_version")
+
+
+def _get_major_minor(x):
+    try:
+        version = Version(x)
+    except InvalidVersion:
+        return "0.0"
+    if version.major > 50:
+        return "0.0"  # invalid version
+    return f"{version.major}.{version.minor}"
+
+
+def _read_csv(file: Path) -> pd.DataFrame:
+    return pd.read_csv(
+        file,
+        converters={
+            "python_version": lambda x: _get_major_minor(x),
+            "pip_version": lambda x: _get_major_minor(x),
+            "glibc_version": lambda x: _get_major_minor(x),
+        },
+    )
+
+
+def _get_month_path(month: date) -> Path:
+    return utils.CONSUMER_STORE_PATH / f"{month.strftime('%Y-%m')}.npz"
+
+
+def _load_month(month: date) -> dict[str, np.ndarray] | None:
+    store_file = _get_month_path(month)
+    if not store_file.exists():
+        return None
+    with np.load(store_file, allow_pickle=False) as data:
+        if int(data["store_version"]) != _STORE_VERSION:
+            _LOGGER.info(f"{store_file.name}: outdated store, rebuilding")
+            return None
+        return dict(data)
+
+
+def _save_month(month: date, data: dict[str, np.ndarray]) -> None:
+    utils.CONSUMER_STORE_PATH.mkdir(exist_ok=True)
+    with utils.atomic_write(_get_month_path(month)) as tmp_file:
+        np.savez(tmp_file, store_version=np.int64(_STORE_VERSION), **data)
+
+
+def _decode(
+    data: dict[str, np.ndarray], column: str, mask: np.ndarray | None = None
+) -> np.ndarray:
+    codes = data[column] if mask is None else data[column][mask]
+    values = data[f"{column}_categories"].astype(object)[codes]
+    values[codes < 0] = np.nan
+    return values
+
+
+def _encode(
+    data: dict[str, np.ndarray] | None, days: list[int], df: pd.DataFrame
+) -> dict[str, np.ndarray]:
+    # merge the rows of `days` found in `df` with already stored ones
+    # categories are stored alongside codes, -1 being a missing value
+    if data is None:
+        data = {
+            "days": np.zeros(0, dtype=np.int8),
+            "day": np.zeros(0, dtype=np.int8),
+            "num_downloads": np.zeros(0, dtype=np.int64),
+        }
+        for column in _CATEGORICAL_COLUMNS:
+            data[column] = np.zeros(0, dtype=np.int16)
+            data[f"{column}_categories"] = np.zeros(0, dtype=str)
+    result = {
+        "days": np.sort(np.concatenate([data["days"], days]).astype(np.int8)),
+        "day": np.concatenate([data["day"], df["day"].to_numpy(dtype=np.int8)]),
+        "num_downloads": np.concatenate(
+            [data["num_downloads"], df["num_downloads"].to_numpy(dtype=np.int64)]
+        ),
+    }
+    for column in _CATEGORICAL_COLUMNS:
+        values = np.concatenate(
+            [_decode(data, column), df[column].to_numpy(dtype=object)]
+        )
+        codes, uniques = pd.factorize(values)
+        result[column] = codes.astype(np.int16)
+        result[f"{column}_categories"] = np.asarray(uniques, dtype=str)
+    order = np.argsort(result["day"], kind="stable")
+    for column in ("day", "num_downloads") + _CATEGORICAL_COLUMNS:
+        result[column] = result[column][order]
+    return result
+
+
+def _update_month(path: Path, month: date) -> dict[str, np.ndarray] | None:
+    folder = path / month.strftime("%Y") / month.strftime("%m")
+    data = _load_month(month)
+    known_days = set() if data is None else set(data["days"].tolist())
+    new_days = sorted(
+        int(file.stem)
+        for file in folder.glob("*.csv")
+        if int(file.stem) not in known_days
+    )
+    if not new_days:
+        return data
+    metrics.count("consumer_days_compacted", len(new_days))
+    _LOGGER.debug(f"consumer store: adding {len(new_days)} days to {month:%Y-%m}")
+    dataframes = []
+    for day in new_days:
+        df = _read_csv(folder / f"{day:02d}.csv")
+        df["day"] = day
+        dataframes.append(df)
+    data = _encode(data, new_days, pd.concat(dataframes))
+    _save_month(month, data)
+    return data
+
+
+def _iter_months(path: Path, start: date, end: date):
+    month = start.replace(day=1)
+    while month < end:
+        yield month, _update_month(path, month)
+        month = (month + timedelta(days=31)).replace(day=1)
+
+
+def get_days(path: Path, start: date, end: date) -> set[date]:
+    # days in [start, end) for which consumer data is available
+    result = set()
+    for month, data in _iter_months(path, start, end):
+        if data is not None:
+            for day in data["days"].tolist():
+                day_ = month.replace(day=day)
+                if start <= day_ < end:
+                    result.add(day_)
+    return result
+
+
+def load(path: Path, start: date, end: date) -> pd.DataFrame:
+    # consumer data for [start, end) from the monthly store. Months are
+    # compacted from the daily CSV files of path the first time they are read,
+    # new days are appended to the store as they show up.
+    dataframes = []
+    for month, data in _iter_months(path, start, end):
+        if data is not None:
+            day = data["day"].astype(np.int64)
+            first = (start - month).days + 1
+            last = (end - month).days + 1
+            mask = (day >= first) & (day < last)
+            df = pd.DataFrame(
+                {column: _decode(data, column, mask) for column in _CATEGORICAL_COLUMNS}
+            )
+            df.insert(1, "num_downloads", data["num_downloads"][mask])
+            df["day"] = pd.to_datetime(month) + pd.to_timedelta(day[mask] - 1, "D")
+            dataframes.append(df)
+            metrics.count("consumer_days_loaded", len(np.unique(day[mask])))
+            metrics.count("consumer_rows_loaded", len(df))
+    return pd.concat(dataframes, ignore_index=True)
@@ -0,0 +1,142 @@
+import contextlib
+import contextvars
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from collections.abc import Iterator
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+import utils
+
+_LOGGER = logging.getLogger(__name__)
+_PROMETHEUS_PREFIX = "manylinux_timeline"
+# stages in the order they ended
+_stages: list[dict[str, Any]] = []
+# counters of the stage running in the current thread or task
+_counters: contextvars.ContextVar[Counter[str] | None] = contextvars.ContextVar(
+    "counters", default=None
+)
+_started = datetime.now(timezone.utc)
+_start_time = time.perf_counter()
+# stages may run concurrently, process wide peaks are only reset when no
+# other stage is running
+_running = 0
+_running_lock = threading.Lock()
+
+
+def _reset_peak_rss() -> None:
+    # linux only, makes VmHWM start again from the current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _get_peak_rss() -> int:
+    # bytes, falls back to the peak of the whole process when VmHWM isn't
+    # available
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def _get_cpu_time() -> float:
+    # time of the current thread, worker processes are accounted once they've
+    # been waited for
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.thread_time() + children.ru_utime + children.ru_stime
+
+
+def count(name: str, value: int = 1) -> None:
+    counters = _counters.get()
+    if counters is not None:
+        counters[name] += value
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    global _running
+    counters: Counter[str] = Counter()
+    token = _counters.set(counters)
+    with _running_lock:
+        if _running == 0:
+            _reset_peak_rss()
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+        _running += 1
+    start_cpu = _get_cpu_time()
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _running_lock:
+            _running -= 1
+        _counters.reset(token)
+        result: dict[str, Any] = {
+            "name": name,
+            "start": round(start_time - _start_time, 3),
+            "seconds": round(time.perf_counter() - start_time, 3),
+            "cpu_seconds": round(_get_cpu_time() - start_cpu, 3),
+            "peak_rss_mb": round(_get_peak_rss() / 2**20, 1),
+        }
+        if tracemalloc.is_tracing():
+            peak_traced = tracemalloc.get_traced_memory()[1]
+            result["peak_traced_mb"] = round(peak_traced / 2**20, 1)
+        result["counters"] = counters
+        _stages.append(result)
+        _LOGGER.info(f"stage {name}: {result['seconds']}s")
+
+
+def _get_report() -> dict[str, Any]:
+    stages = [{**s, "counters": dict(sorted(s["counters"].items()))} for s in _stages]
+    return {
+        "started": _started.isoformat(timespec="seconds"),
+        "seconds": round(time.perf_counter() - _start_time, 3),
+        "stages": stages,
+    }
+
+
+def write(path: Path) -> None:
+    with open(path, "w") as f:
+        json.dump(_get_report(), f, indent=2)
+        f.write("\n")
+
+
+def write_prometheus(path: Path) -> None:
+    # node_exporter textfile collector format, the file is replaced at once
+    # so that the collector never reads a partial file
+    lines = [
+        f"# TYPE {_PROMETHEUS_PREFIX}_last_run_timestamp_seconds gauge",
+        f"{_PROMETHEUS_PREFIX}_last_run_timestamp_seconds "
+        f"{_started.timestamp():.0f}",
+    ]
+    measures = ("seconds", "cpu_seconds", "peak_rss_mb", "peak_traced_mb")
+    for measure in measures:
+        values = [(s["name"], s[measure]) for s in _stages if measure in s]
+        if values:
+            metric = f"{_PROMETHEUS_PREFIX}_stage_{measure}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.extend(f'{metric}{{stage="{n}"}} {v}' for n, v in values)
+    names = sorted({name for s in _stages for name in s["counters"]})
+    for name in names:
+        metric = f"{_PROMETHEUS_PREFIX}_{name}"
+        lines.append(f"# TYPE {metric} gauge")
+        for s in _stages:
+            if name in s["counters"]:
+                lines.append(f'{metric}{{stage="{s["name"]}"}} {s["counters"][name]}')
+    with utils.atomic_write(path) as tmp_file:
+        tmp_file.write_text("\n".join(lines) + "\n")
@@ -0,0 +1,71 @@
+import json
+import logging
+from collections.abc import Iterable
+from datetime import date, timedelta
+
+from packaging.utils import canonicalize_name
+
+import utils
+
+_LOGGER = logging.getLogger(__name__)
+# reason: delay before checking a package again the first time, the delay
+# doubles each time the same outcome is observed again
+REASONS = {
+    "removed": timedelta(days=30),  # 404 on PyPI
+    "no-manylinux": timedelta(days=7),  # no release with manylinux wheels
+    "invalid": timedelta(days=7),  # manylinux wheels but nothing usable
+}
+_MAX_DELAY = timedelta(days=180)
+
+
+class NegativeCache:
+    # packages known not to be worth fetching, keyed by canonical name
+
+    def __init__(self, today: date | None = None) -> None:
+        self._today = date.today() if today is None else today
+        self._entries: dict[str, dict[str, str | int]] = {}
+        if utils.NEGATIVE_CACHE_PATH.exists():
+            with open(utils.NEGATIVE_CACHE_PATH) as f:
+                self._entries = json.load(f)
+
+    def __contains__(self, package: str) -> bool:
+        entry = self._entries.get(canonicalize_name(package))
+        return entry is not None and self._today < date.fromisoformat(
+            str(entry["until"])
+        )
+
+    def add(self, package: str, reason: str) -> None:
+        name = canonicalize_name(package)
+        entry = self._entries.get(name)
+        count = 1
+        if entry is not None and entry["reason"] == reason:
+            count = int(entry["count"]) + 1
+        delay = min(REASONS[reason] * 2 ** min(count - 1, 16), _MAX_DELAY)
+        until = self._today + delay
+        _LOGGER.debug(f'"{package}": {reason}, skipped until {until}')
+        self._entries[name] = {
+            "reason": reason,
+            "count": count,
+            "until": until.isoformat(),
+        }
+
+    def discard(self, package: str) -> None:
+        self._entries.pop(canonicalize_name(package), None)
+
+    def get_entries(self, packages: Iterable[str]) -> dict[str, dict[str, str | int]]:
+        names = sorted({canonicalize_name(package) for package in packages})
+        return {name: self._entries[name] for name in names if name in self._entries}
+
+    def set_entries(
+        self, packages: Iterable[str], entries: dict[str, dict[str, str | int]]
+    ) -> None:
+        # replaces the entries of packages with entries, as returned by the
+        # get_entries of another negative cache
+        for package in packages:
+            self._entries.pop(canonicalize_name(package), None)
+        self._entries.update(entries)
+
+    def save(self) -> None:
+        with utils.atomic_write(utils.NEGATIVE_CACHE_PATH) as tmp_file:
+            with open(tmp_file, "w") as f:
+                json.dump(self._entries, f, indent=0, sort_keys=True)
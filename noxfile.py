@@ -1,4 +1,11 @@
+import json
 import os
+import re
+import shutil
+import socket
+import subprocess
+import time
+import urllib.request
 from pathlib import Path
 
 import nox
@@ -32,6 +39,8 @@ def update_requirements(session: nox.Session) -> None:
         "--allow-unsafe",
         "--upgrade",
         "--generate-hashes",
+        # index options come from the environment of whoever runs this
+        "--no-emit-index-url",
         "requirements.in",
         env=env,
     )
@@ -44,6 +53,143 @@ def run(session: nox.Session) -> None:
     session.run("python", "update.py", *session.posargs)
 
 
+@nox.session(python=PYTHON_VERSION)
+def benchmark(session: nox.Session) -> None:
+    """Run benchmarks against local stand-ins."""
+    session.install("--require-hashes", "-r", "requirements.txt")
+    session.run("python", "benchmark.py", *(session.posargs or ["fetch"]))
+
+
+@nox.session(python=PYTHON_VERSION)
+def importtime(session: nox.Session) -> None:
+    """Check that startup doesn't import the dependencies of the stages."""
+    session.install("--require-hashes", "-r", "requirements.txt")
+    heavy = {"google", "httpx", "ijson", "lastversion", "numpy", "pandas", "requests"}
+    output = session.run(
+        "python", "-X", "importtime", "update.py", "--help", silent=True
+    )
+    # session.run only returns None when commands are skipped (--install-only)
+    assert output is not None
+    # import time: self [us] | cumulative | imported package
+    cumulative = {}
+    total = 0
+    for line in output.splitlines():
+        if not line.startswith("import time:") or line.endswith("imported package"):
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        total += int(self_us)
+        cumulative[name.strip()] = int(cumulative_us)
+    session.log(f"startup imports: {total / 1000:.1f}ms")
+    for name in sorted(cumulative, key=cumulative.__getitem__, reverse=True)[:10]:
+        session.log(f"{cumulative[name] / 1000:8.1f}ms {name}")
+    imported = sorted({name.split(".")[0] for name in cumulative} & heavy)
+    if imported:
+        session.error(f"imported at startup: {', '.join(imported)}")
+
+
+@nox.session(python=PYTHON_VERSION)
+def stand_in(session: nox.Session) -> None:
+    """Update the cache of a few packages from the PyPI stand-in."""
+    session.install("--require-hashes", "-r", "requirements.txt")
+    packages = [f"pkg{i}" for i in range(30)]
+    # what the stand-in answers with its default seed and the ratios below
+    removed = {"pkg4", "pkg10", "pkg19", "pkg20", "pkg25", "pkg28"}
+    moved = {"pkg7", "pkg9", "pkg14", "pkg15", "pkg23", "pkg27"}
+    # a copy of the tree, the update writes packages.json & cache next to it
+    root = Path(session.create_tmp()) / "root"
+    shutil.rmtree(root, ignore_errors=True)
+    shutil.copytree(
+        HERE,
+        root,
+        ignore=shutil.ignore_patterns(
+            ".git",
+            ".nox",
+            "*_cache",
+            "__pycache__",
+            "build*",
+            "cache",
+            "consumer_data",
+            "pypi-data",
+        ),
+    )
+    root.joinpath("packages.json").write_text(json.dumps(packages))
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    # 429s are retried, 5 attempts in each of the 2 passes of the update. A
+    # moved package takes 2 requests per attempt, either one can get a 429,
+    # so now and then one of them fails and keeps its old name.
+    server = subprocess.Popen(
+        [
+            Path(session.bin) / "python",
+            root / "pypi_stand_in.py",
+            "serve",
+            f"--port={port}",
+            "--removed-ratio=0.15",
+            "--moved-ratio=0.15",
+            "--throttle-ratio=0.2",
+            "--retry-after=0.1",
+        ]
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(f"{url}/stats").close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        def update(*args: str) -> str:
+            output = session.run(
+                "python",
+                root / "update.py",
+                "--only=cache",
+                f"--index-url={url}/pypi",
+                *args,
+                env={"GITHUB_EVENT_NAME": "push", "BIGQUERY_TOKEN": ""},
+                silent=True,
+            )
+            assert output is not None
+            return output
+
+        update("--update-all")
+        with urllib.request.urlopen(f"{url}/stats") as response:
+            stats = json.load(response)
+        session.log(f"stand-in responses: {stats}")
+        result = json.loads(root.joinpath("packages.json").read_text())
+        # packages that failed keep their name, there should only be a few
+        kept = set(result) & (removed | moved)
+        expected = sorted(
+            {p for p in packages if p not in removed | moved}
+            | {f"{p}-renamed" for p in moved - kept}
+            | kept
+        )
+        if result != expected or len(kept) > 2:
+            session.error(f"packages.json: expected {expected}, got {result}")
+        for status in ("301", "404", "429"):
+            if status not in stats:
+                session.error(f"the stand-in never answered {status}")
+
+        # the first run with a changelog is a full update that saves its serial,
+        # the next one only refreshes the packages of newer events
+        feed = root / "feed.json"
+        events = [["pkg0", "1.0", 0, "new release", 1]]
+        feed.write_text(json.dumps(events))
+        update("--changelog", f"--changelog-url={feed}")
+        events += [["pkg1", "1.1", 0, "new release", 2], ["Pkg3", "", 0, "remove", 3]]
+        feed.write_text(json.dumps(events))
+        state = json.loads(root.joinpath("cache", "changelog.json").read_text())
+        output = update("--changelog", f"--changelog-url={feed}", "-v")
+    finally:
+        server.terminate()
+        server.wait()
+    refreshed = sorted(set(re.findall(r'"(\S+)": begin update', output)))
+    expected = sorted({"pkg1", "pkg3"} | set(state["pending"]))
+    if refreshed != expected:
+        session.error(f"changelog: expected {expected} refreshed, got {refreshed}")
+
+
 @nox.session(python=PYTHON_VERSION, venv_backend="none")
 def timestamp(session: nox.Session) -> None:
     """Get timestamp for PyPI package cache on GHA"""
@@ -0,0 +1,70 @@
+import graphlib
+import logging
+from collections.abc import Callable, Iterable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any
+
+import metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class Stage:
+    name: str
+    # called with the outputs of the `inputs` stages, in that order, the value
+    # returned is the output of the stage
+    run: Callable[..., Any]
+    inputs: tuple[str, ...] = ()
+
+
+def _run_stage(stage: Stage, args: list[Any]) -> Any:
+    _LOGGER.debug(f"stage {stage.name}: begin")
+    with metrics.stage(stage.name):
+        return stage.run(*args)
+
+
+def run(stages: Iterable[Stage]) -> dict[str, Any]:
+    # Runs each stage in its own thread as soon as its inputs are available,
+    # independent stages overlap. When a stage fails, no other stage is
+    # started, the running ones are waited for and the error is raised.
+    stages_by_name = {stage.name: stage for stage in stages}
+    for stage in stages_by_name.values():
+        for name in stage.inputs:
+            if name not in stages_by_name:
+                raise ValueError(f"stage {stage.name}: unknown input {name!r}")
+    sorter = graphlib.TopologicalSorter(
+        {stage.name: stage.inputs for stage in stages_by_name.values()}
+    )
+    sorter.prepare()
+    outputs: dict[str, Any] = {}
+    error: BaseException | None = None
+    with ThreadPoolExecutor(len(stages_by_name)) as executor:
+        running: dict[Future[Any], str] = {}
+        while error is None and sorter.is_active():
+            for name in sorter.get_ready():
+                stage = stages_by_name[name]
+                args = [outputs[input_] for input_ in stage.inputs]
+                running[executor.submit(_run_stage, stage, args)] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    outputs[name] = future.result()
+                except BaseException as e:
+                    _LOGGER.error(f"stage {name}: failed with {e!r}")
+                    if error is None:
+                        error = e
+                else:
+                    sorter.done(name)
+        if running:
+            _LOGGER.info(f"waiting for stages {sorted(running.values())}")
+        for future, name in running.items():
+            try:
+                future.result()
+            except BaseException as e:
+                _LOGGER.error(f"stage {name}: failed with {e!r}")
+    if error is not None:
+        raise error
+    return outputs
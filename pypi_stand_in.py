@@ -0,0 +1,289 @@
+import argparse
+import functools
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any
+
+import httpx
+
+import utils
+
+_LOGGER = logging.getLogger(__name__)
+# a package that "moved" is redirected to its name with this suffix
+_RENAMED_SUFFIX = "-renamed"
+_PLATFORMS = (
+    "manylinux1_x86_64",
+    "manylinux_2_17_x86_64.manylinux2014_x86_64",
+    "manylinux_2_17_aarch64.manylinux2014_aarch64",
+    "manylinux_2_28_x86_64",
+    "musllinux_1_1_x86_64",
+    "macosx_11_0_arm64",
+    "win_amd64",
+)
+
+
+@dataclass
+class StandInOptions:
+    # directory of recorded <package>.json documents, synthetic ones otherwise
+    source: Path | None = None
+    latency: float = 0.0  # seconds added to every response
+    jitter: float = 0.0  # up to that many seconds added on top of latency
+    removed_ratio: float = 0.0  # packages answered with a 404
+    moved_ratio: float = 0.0  # packages answered with a 301
+    throttle_ratio: float = 0.0  # requests answered with a 429
+    retry_after: float = 1.0
+    seed: int = 0
+
+
+def _get_fraction(seed: int, package: str, kind: str) -> float:
+    # stable across runs, so that a package is always removed or always served
+    digest = hashlib.sha256(f"{seed}:{kind}:{package}".encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64
+
+
+def _hex(rng: random.Random, bits: int) -> str:
+    return f"{rng.getrandbits(bits):0{bits // 4}x}"
+
+
+def _synthetic_file(
+    rng: random.Random, filename: str, python: str, upload_time: datetime
+) -> dict[str, Any]:
+    # same fields as PyPI, most of them are of no use to update_cache but they
+    # are part of what it has to download and parse
+    sha256 = _hex(rng, 256)
+    return {
+        "comment_text": "",
+        "digests": {
+            "blake2b_256": _hex(rng, 256),
+            "md5": _hex(rng, 128),
+            "sha256": sha256,
+        },
+        "downloads": -1,
+        "filename": filename,
+        "has_sig": False,
+        "md5_digest": _hex(rng, 128),
+        "packagetype": "sdist" if python == "source" else "bdist_wheel",
+        "python_version": python,
+        "requires_python": ">=3.8",
+        "size": rng.randint(10_000, 50_000_000),
+        "upload_time": upload_time.isoformat(timespec="seconds"),
+        "upload_time_iso_8601": upload_time.isoformat(timespec="microseconds") + "Z",
+        "url": f"https://files.pythonhosted.org/packages/{sha256[:2]}/"
+        f"{sha256[2:4]}/{sha256[4:]}/{filename}",
+        "yanked": False,
+        "yanked_reason": None,
+    }
+
+
+@functools.lru_cache(maxsize=1024)
+def _synthetic_document(seed: int, package: str) -> bytes:
+    rng = random.Random(f"{seed}:{package}")
+    name = package.replace("-", "_")
+    pure_python = rng.random() < 0.3
+    upload_time = datetime(2015, 1, 1) + timedelta(seconds=rng.randint(0, 3 * 10**8))
+    releases = {}
+    for major in range(1, rng.randint(1, 5) + 1):
+        for minor in range(rng.randint(1, 8)):
+            version = f"{major}.{minor}.0"
+            upload_time += timedelta(seconds=rng.randint(86_400, 10**7))
+            files = [
+                _synthetic_file(rng, f"{name}-{version}.tar.gz", "source", upload_time)
+            ]
+            if pure_python:
+                filename = f"{name}-{version}-py3-none-any.whl"
+                files.append(_synthetic_file(rng, filename, "py3", upload_time))
+            else:
+                first = rng.randint(6, 10)
+                for python in range(first, first + rng.randint(1, 4)):
+                    tag = f"cp3{python}"
+                    for platform in rng.sample(_PLATFORMS, rng.randint(1, 5)):
+                        filename = f"{name}-{version}-{tag}-{tag}-{platform}.whl"
+                        files.append(_synthetic_file(rng, filename, tag, upload_time))
+            releases[version] = files
+    document = {
+        "info": {"name": package, "version": version, "summary": f"{package}"},
+        "last_serial": rng.randint(1, 2 * 10**7),
+        "releases": releases,
+        "urls": releases[version],
+        "vulnerabilities": [],
+    }
+    return json.dumps(document).encode()
+
+
+class StandInServer(ThreadingHTTPServer):
+    # serves /pypi/<package>/json like PyPI, with ETag/304 support
+    request_queue_size = 1024
+
+    def __init__(self, address: tuple[str, int], options: StandInOptions) -> None:
+        super().__init__(address, _Handler)
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.stats: Counter[int] = Counter()
+        self._stats_lock = threading.Lock()
+
+    @property
+    def index_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host!s}:{port}/pypi"
+
+    def count(self, status: int) -> None:
+        with self._stats_lock:
+            self.stats[status] += 1
+
+    def get_document(self, package: str) -> bytes | None:
+        package = package.removesuffix(_RENAMED_SUFFIX)
+        if self.options.source is None:
+            return _synthetic_document(self.options.seed, package)
+        try:
+            return (self.options.source / f"{package}.json").read_bytes()
+        except FileNotFoundError:
+            return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: StandInServer
+
+    def log_message(self, format: str, *args: Any) -> None:
+        _LOGGER.debug(format, *args)
+
+    def _send(
+        self, status: int, headers: dict[str, str] | None = None, body: bytes = b""
+    ) -> None:
+        self.server.count(status)
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        options = self.server.options
+        if self.path == "/stats":
+            stats = {str(k): v for k, v in sorted(self.server.stats.items())}
+            self._send(
+                200, {"Content-Type": "application/json"}, json.dumps(stats).encode()
+            )
+            return
+        delay = options.latency + self.server.random.uniform(0.0, options.jitter)
+        if delay > 0.0:
+            time.sleep(delay)
+        parts = self.path.split("/")
+        if len(parts) != 4 or parts[1] != "pypi" or parts[3] != "json":
+            self._send(404)
+            return
+        package = parts[2]
+        if self.server.random.random() < options.throttle_ratio:
+            self._send(429, {"Retry-After": f"{options.retry_after:g}"})
+            return
+        if not package.endswith(_RENAMED_SUFFIX):
+            if _get_fraction(options.seed, package, "removed") < options.removed_ratio:
+                self._send(404)
+                return
+            if _get_fraction(options.seed, package, "moved") < options.moved_ratio:
+                location = f"{self.server.index_url}/{package}{_RENAMED_SUFFIX}/json"
+                self._send(301, {"Location": location})
+                return
+        document = self.server.get_document(package)
+        if document is None:
+            self._send(404)
+            return
+        etag = f'"{hashlib.sha256(document).hexdigest()[:32]}"'
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, {"ETag": etag})
+            return
+        headers = {"Content-Type": "application/json", "ETag": etag}
+        self._send(200, headers, document)
+
+
+def record(directory: Path, packages: list[str]) -> None:
+    # saves the current PyPI documents of packages to be served later
+    directory.mkdir(parents=True, exist_ok=True)
+    with httpx.Client(
+        headers={"User-Agent": utils.USER_AGENT}, follow_redirects=True
+    ) as client:
+        for package in packages:
+            response = client.get(f"{utils.PYPI_URL}/{package}/json")
+            if response.is_error:
+                _LOGGER.warning(f'"{package}": {response.status_code}, not recorded')
+                continue
+            (directory / f"{package}.json").write_bytes(response.content)
+            _LOGGER.info(f'"{package}": recorded')
+
+
+def serve(host: str, port: int, options: StandInOptions) -> None:
+    with StandInServer((host, port), options) as server:
+        _LOGGER.warning(f"serving {server.index_url}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Stand-in for the PyPI JSON API",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="serve documents")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", default=8000, type=int)
+    serve_parser.add_argument(
+        "--source",
+        type=Path,
+        help="directory of recorded documents, synthetic ones are served otherwise",
+    )
+    serve_parser.add_argument(
+        "--latency", default=0.0, type=float, help="seconds added to each response"
+    )
+    serve_parser.add_argument(
+        "--jitter", default=0.0, type=float, help="random seconds added to latency"
+    )
+    serve_parser.add_argument(
+        "--removed-ratio", default=0.0, type=float, help="ratio of 404 packages"
+    )
+    serve_parser.add_argument(
+        "--moved-ratio", default=0.0, type=float, help="ratio of 301 packages"
+    )
+    serve_parser.add_argument(
+        "--throttle-ratio", default=0.0, type=float, help="ratio of 429 responses"
+    )
+    serve_parser.add_argument(
+        "--retry-after", default=1.0, type=float, help="Retry-After of 429 responses"
+    )
+    serve_parser.add_argument("--seed", default=0, type=int)
+    record_parser = subparsers.add_parser("record", help="record PyPI documents")
+    record_parser.add_argument("directory", type=Path)
+    record_parser.add_argument("packages", nargs="+")
+    parser.add_argument(
+        "-v", "--verbosity", action="count", help="increase output verbosity"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=30 - 10 * min(args.verbosity or 0, 2))
+    if args.command == "record":
+        record(args.directory, args.packages)
+    else:
+        serve(
+            args.host,
+            args.port,
+            StandInOptions(
+                args.source,
+                args.latency,
+                args.jitter,
+                args.removed_ratio,
+                args.moved_ratio,
+                args.throttle_ratio,
+                args.retry_after,
+                args.seed,
+            ),
+        )
@@ -0,0 +1,309 @@
+import abc
+import itertools
+import json
+import logging
+import sqlite3
+from collections.abc import Iterable, Iterator
+from datetime import date
+from shutil import move
+from typing import Any
+
+from packaging.version import InvalidVersion, Version
+
+import utils
+
+_LOGGER = logging.getLogger(__name__)
+BACKENDS = ("json", "sqlite")
+# version of the layout of the info stored for each package, see summarize
+SCHEMA_VERSION = 2
+# number of writes grouped in a single sqlite transaction
+_BATCH_SIZE = 256
+
+
+def _summarize_release(upload_date: str, filenames: list[str]) -> list[str]:
+    pythons = set()
+    manylinux = set()
+    for filename in filenames:
+        if not filename.lower().endswith(".whl"):
+            continue
+        metadata = utils.parse_wheel_filename(filename)
+        if metadata is None:
+            continue
+        valid_pythons, invalid_pythons = utils.split_python_tags(
+            metadata.implementation
+        )
+        for python in invalid_pythons:
+            _LOGGER.warning(f'ignoring python "{python}" for wheel "{filename}"')
+        for python in valid_pythons:
+            pythons.add(python)
+            if metadata.abi == "abi3":
+                if not python.startswith("cp3"):
+                    _LOGGER.warning(
+                        f'ignoring python "{python}-abi3" for wheel "{filename}"'
+                    )
+                    continue
+                # Add abi3 to know that cp3? > {python} are supported
+                pythons.add("ab3")
+        manylinux.add(metadata.platform)
+    python_list = list(pythons)
+    python_list.sort(key=lambda x: (int(x[2:]), x[0:2]))
+    python_str = ".".join(python_list).replace("ab3", "abi3")
+    manylinux_str = ".".join(sorted(manylinux)).replace("anylinux", "l")
+    return [upload_date, python_str, manylinux_str]
+
+
+def summarize(
+    package: str, releases: dict[str, tuple[str, list[str]]]
+) -> list[list[str]]:
+    # releases maps versions to their first upload date and the name of their
+    # manylinux wheels. Those are reduced to what update_dataset needs:
+    # [version, first upload date, python tags, manylinux platforms]
+    # sorted from the newest version to the oldest one.
+    candidate_versions = []
+    for version in releases:
+        try:
+            candidate_versions.append((version, Version(version)))
+        except InvalidVersion as e:
+            _LOGGER.warning(f'"{package}": {e}')
+    candidate_versions.sort(key=lambda x: x[1], reverse=True)
+    return [
+        [version, *_summarize_release(*releases[version])]
+        for version, _ in candidate_versions
+    ]
+
+
+def _migrate(package: str, info: dict[str, Any], schema: int) -> dict[str, Any]:
+    if schema < 2:
+        # releases used to be stored as the list of their manylinux wheels
+        # along with a fake "ut-1.zip" file holding the first upload date
+        releases = {
+            version: (
+                min(file["upload_time"] for file in files),
+                [file["filename"] for file in files],
+            )
+            for version, files in info["releases"].items()
+        }
+        info = {"etag": info["etag"], "releases": summarize(package, releases)}
+    return info
+
+
+def _get_json_schema() -> int:
+    schema_file = utils.RELEASE_INFO_PATH / "schema"
+    if schema_file.exists():
+        return int(schema_file.read_text())
+    if utils.RELEASE_INFO_PATH.exists():
+        return 1  # not versioned
+    return SCHEMA_VERSION
+
+
+class ReleaseCache(abc.ABC):
+    # info of packages as written by update_cache:
+    # {"etag": ..., "releases": summarize(...)}
+
+    @abc.abstractmethod
+    def get_etag(self, package: str) -> str | None:
+        ...
+
+    @abc.abstractmethod
+    def put(self, package: str, info: dict[str, Any]) -> None:
+        ...
+
+    @abc.abstractmethod
+    def move(self, package: str, package_new_name: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def get_stamps(self, packages: Iterable[str]) -> dict[str, str]:
+        # a cheap marker that changes whenever the info of a package changes
+        ...
+
+    @abc.abstractmethod
+    def iter_raw(self, packages: Iterable[str]) -> Iterator[tuple[str, str]]:
+        # the JSON text of the info of packages in the cache
+        ...
+
+    def get_last_uploads(self, packages: Iterable[str]) -> dict[str, date]:
+        # upload date of the newest manylinux release of packages
+        result = {}
+        for package, raw_info in self.iter_raw(packages):
+            releases = json.loads(raw_info)["releases"]
+            if releases:
+                result[package] = date.fromisoformat(max(r[1] for r in releases))
+        return result
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "ReleaseCache":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+class JsonReleaseCache(ReleaseCache):
+    # one file per package in cache/info
+
+    def __init__(self) -> None:
+        schema = _get_json_schema()
+        utils.RELEASE_INFO_PATH.mkdir(parents=True, exist_ok=True)
+        if schema < SCHEMA_VERSION:
+            _LOGGER.info(
+                f"migrating {utils.RELEASE_INFO_PATH} to schema {SCHEMA_VERSION}"
+            )
+            for cache_file in utils.RELEASE_INFO_PATH.glob("*.json"):
+                info = json.loads(cache_file.read_text())
+                info = _migrate(cache_file.stem, info, schema)
+                cache_file.write_text(json.dumps(info))
+        (utils.RELEASE_INFO_PATH / "schema").write_text(f"{SCHEMA_VERSION}\n")
+
+    def get_etag(self, package: str) -> str | None:
+        cache_file = utils.get_release_cache_path(package)
+        if not cache_file.exists():
+            return None
+        with open(cache_file) as f:
+            return str(json.load(f)["etag"])
+
+    def put(self, package: str, info: dict[str, Any]) -> None:
+        with open(utils.get_release_cache_path(package), "w") as f:
+            json.dump(info, f)
+
+    def move(self, package: str, package_new_name: str) -> None:
+        move(
+            utils.get_release_cache_path(package),
+            utils.get_release_cache_path(package_new_name),
+        )
+
+    def get_stamps(self, packages: Iterable[str]) -> dict[str, str]:
+        # update_cache only rewrites a file when PyPI sent a new ETag
+        result = {}
+        for package in packages:
+            try:
+                stat = utils.get_release_cache_path(package).stat()
+            except FileNotFoundError:
+                continue
+            result[package] = f"{stat.st_mtime_ns}:{stat.st_size}"
+        return result
+
+    def iter_raw(self, packages: Iterable[str]) -> Iterator[tuple[str, str]]:
+        for package in packages:
+            cache_file = utils.get_release_cache_path(package)
+            if cache_file.exists():
+                yield package, cache_file.read_text()
+
+
+class SqliteReleaseCache(ReleaseCache):
+    # all packages in a single database, much faster to save/restore on CI
+    # than thousands of small files
+
+    def __init__(self) -> None:
+        utils.CACHE_PATH.mkdir(exist_ok=True)
+        exists = utils.RELEASE_DB_PATH.exists()
+        # stages run in threads, the cache is used by one stage at a time
+        self._connection = sqlite3.connect(
+            utils.RELEASE_DB_PATH, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS release_info ("
+            "package TEXT PRIMARY KEY, etag TEXT NOT NULL, info TEXT NOT NULL)"
+        )
+        self._connection.commit()
+        self._pending = 0
+        if not exists:
+            self._set_schema(_get_json_schema())
+            if utils.RELEASE_INFO_PATH.exists():
+                self._import_json()
+        schema = self._connection.execute("PRAGMA user_version").fetchone()[0]
+        if schema < SCHEMA_VERSION:
+            self._migrate(schema)
+
+    def _set_schema(self, schema: int) -> None:
+        self._connection.execute(f"PRAGMA user_version={schema:d}")
+
+    def _import_json(self) -> None:
+        _LOGGER.info(f"importing {utils.RELEASE_INFO_PATH} in release database")
+        with self._connection:
+            for cache_file in utils.RELEASE_INFO_PATH.glob("*.json"):
+                info = cache_file.read_text()
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO release_info VALUES (?, ?, ?)",
+                    (cache_file.stem, json.loads(info)["etag"], info),
+                )
+
+    def _migrate(self, schema: int) -> None:
+        _LOGGER.info(f"migrating release database to schema {SCHEMA_VERSION}")
+        with self._connection:
+            for package, info in self._connection.execute(
+                "SELECT package, info FROM release_info"
+            ).fetchall():
+                info = _migrate(package, json.loads(info), schema)
+                self._connection.execute(
+                    "UPDATE release_info SET info = ? WHERE package = ?",
+                    (json.dumps(info), package),
+                )
+            self._set_schema(SCHEMA_VERSION)
+
+    def _written(self) -> None:
+        # writes are grouped in transactions, reads from this connection
+        # already see the pending ones
+        self._pending += 1
+        if self._pending >= _BATCH_SIZE:
+            self._connection.commit()
+            self._pending = 0
+
+    def get_etag(self, package: str) -> str | None:
+        row = self._connection.execute(
+            "SELECT etag FROM release_info WHERE package = ?", (package,)
+        ).fetchone()
+        return None if row is None else str(row[0])
+
+    def put(self, package: str, info: dict[str, Any]) -> None:
+        self._connection.execute(
+            "INSERT OR REPLACE INTO release_info VALUES (?, ?, ?)",
+            (package, info["etag"], json.dumps(info)),
+        )
+        self._written()
+
+    def move(self, package: str, package_new_name: str) -> None:
+        self._connection.execute(
+            "INSERT OR REPLACE INTO release_info "
+            "SELECT ?, etag, info FROM release_info WHERE package = ?",
+            (package_new_name, package),
+        )
+        self._connection.execute(
+            "DELETE FROM release_info WHERE package = ?", (package,)
+        )
+        self._written()
+
+    def _select(
+        self, column: str, packages: Iterable[str]
+    ) -> Iterator[tuple[str, str]]:
+        # bulk read, one query per _BATCH_SIZE packages
+        pending = iter(packages)
+        while batch := list(itertools.islice(pending, _BATCH_SIZE)):
+            placeholders = ", ".join("?" * len(batch))
+            yield from self._connection.execute(
+                f"SELECT package, {column} FROM release_info "
+                f"WHERE package IN ({placeholders})",
+                batch,
+            )
+
+    def get_stamps(self, packages: Iterable[str]) -> dict[str, str]:
+        return dict(self._select("etag", packages))
+
+    def iter_raw(self, packages: Iterable[str]) -> Iterator[tuple[str, str]]:
+        yield from self._select("info", packages)
+
+    def close(self) -> None:
+        self._connection.commit()
+        self._connection.close()
+
+
+def open_cache(backend: str = "json") -> ReleaseCache:
+    if backend == "json":
+        return JsonReleaseCache()
+    if backend == "sqlite":
+        return SqliteReleaseCache()
+    raise ValueError(f"unknown cache backend {backend!r}")
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+from collections.abc import Iterable
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from packaging.utils import canonicalize_name
+
+import negative_cache
+import release_cache
+import utils
+
+# The cache update can be spread over several machines: each one runs
+# `update.py --shard i/N` on its own copy of the cache, which only updates the
+# packages of shard i and writes what changed to a shard directory. All the
+# shard directories are then merged into the cache by `--merge-shards`.
+
+_LOGGER = logging.getLogger(__name__)
+# version of the layout of shard.json, shards are only merged by the version
+# that wrote them
+SHARD_VERSION = 1
+_SHARD_FILE_NAME = "shard.json"
+
+
+@dataclass(frozen=True)
+class Shard:
+    index: int
+    count: int
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    def __contains__(self, package: str) -> bool:
+        return get_index(package, self.count) == self.index
+
+    @property
+    def path(self) -> Path:
+        return utils.SHARDS_PATH / f"{self.index}-of-{self.count}"
+
+
+def parse(value: str) -> Shard:
+    # "i/N", 0 <= i < N
+    index, count = (int(part) for part in value.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(value)
+    return Shard(index, count)
+
+
+def get_index(package: str, count: int) -> int:
+    # stable across processes and machines, unlike hash(). The bytes used by
+    # the refresh scheduler of update_cache are left aside, shards would
+    # otherwise not get the same share of the packages due each day.
+    digest = hashlib.sha256(canonicalize_name(package).encode()).digest()
+    return int.from_bytes(digest[-8:], "big") % count
+
+
+def save(
+    shard: Shard,
+    packages: list[str],
+    checked: Iterable[str],
+    removed: Iterable[str],
+    moved: dict[str, str],
+    failed: Iterable[str],
+    cache: release_cache.ReleaseCache,
+    negative: negative_cache.NegativeCache,
+    changelog_state: dict[str, Any] | None,
+    stamps: dict[str, str],
+) -> None:
+    # packages are the packages of the shard before the update, checked the
+    # ones actually requested to PyPI, only those may have changed. stamps are
+    # the cache stamps of checked before the update, the info of packages
+    # whose stamp didn't change is left out, merge keeps their cache entry.
+    checked = set(checked) | set(moved.values())
+    gone = set(removed) | set(moved) | set(failed)
+    before = dict(stamps)
+    for package, package_new_name in moved.items():
+        if package in stamps:
+            before[package_new_name] = stamps[package]
+    changed = [
+        package
+        for package, stamp in sorted(cache.get_stamps(checked - gone).items())
+        if before.get(package) != stamp
+    ]
+    updated = dict(cache.iter_raw(changed))
+    # update_cache only renames the cache entry of a moved package when its
+    # info didn't change, it's otherwise stored again under the new name
+    renamed = [package for package in moved if cache.get_etag(package) is None]
+    document = {
+        "version": SHARD_VERSION,
+        "index": shard.index,
+        "count": shard.count,
+        "packages": sorted(packages),
+        "checked": sorted(checked),
+        "removed": sorted(removed),
+        "moved": dict(sorted(moved.items())),
+        "renamed": sorted(renamed),
+        "failed": sorted(failed),
+        "info": {package: json.loads(updated[package]) for package in sorted(updated)},
+        "negative": negative.get_entries(checked),
+        "changelog": changelog_state,
+    }
+    shard.path.mkdir(parents=True, exist_ok=True)
+    with utils.atomic_write(shard.path / _SHARD_FILE_NAME) as tmp_file:
+        with open(tmp_file, "w") as f:
+            json.dump(document, f, sort_keys=True)
+    _LOGGER.info(f"shard {shard}: {len(updated)} packages updated in {shard.path}")
+
+
+def _load(directories: Iterable[Path]) -> list[dict[str, Any]]:
+    documents = []
+    for directory in directories:
+        with open(directory / _SHARD_FILE_NAME) as f:
+            document = json.load(f)
+        if document["version"] != SHARD_VERSION:
+            raise ValueError(f"{directory}: unsupported version {document['version']}")
+        documents.append(document)
+    documents.sort(key=lambda document: int(document["index"]))
+    # a missing shard would silently drop its packages from the list
+    counts = {int(document["count"]) for document in documents}
+    if len(counts) != 1:
+        raise ValueError(f"shards of different counts {sorted(counts)}")
+    count = counts.pop()
+    indexes = [int(document["index"]) for document in documents]
+    if indexes != list(range(count)):
+        raise ValueError(f"expected shards 0 to {count - 1}, got {indexes}")
+    return documents
+
+
+def _merge_changelog_states(states: list[dict[str, Any]]) -> dict[str, Any]:
+    # the oldest serial, events seen by some shards only are processed again
+    urls = {state["url"] for state in states}
+    if len(urls) != 1:
+        raise ValueError(f"shards used different changelogs {sorted(urls)}")
+    return {
+        "url": urls.pop(),
+        "serial": min(state["serial"] for state in states),
+        "full_update": min(state["full_update"] for state in states),
+        "pending": sorted({p for state in states for p in state["pending"]}),
+    }
+
+
+def merge(
+    directories: Iterable[Path],
+    cache: release_cache.ReleaseCache,
+    negative: negative_cache.NegativeCache,
+) -> tuple[list[str], list[str]]:
+    # Applies the shards to the cache, in the order of their index and of the
+    # package names, so that the result doesn't depend on the order of
+    # directories. Returns the packages of the shards before and after their
+    # update.
+    documents = _load(directories)
+    before: set[str] = set()
+    after: set[str] = set()
+    for document in documents:
+        packages = set(document["packages"])
+        before |= packages
+        after |= (packages - set(document["removed"]) - set(document["moved"])) | set(
+            document["moved"].values()
+        )
+        for package in document["renamed"]:
+            if cache.get_etag(package) is not None:
+                cache.move(package, document["moved"][package])
+        for package, info in document["info"].items():
+            cache.put(package, info)
+        negative.set_entries(document["checked"], document["negative"])
+        _LOGGER.info(
+            f"shard {document['index']}/{document['count']}: "
+            f"{len(document['info'])} packages updated"
+        )
+    states = [document["changelog"] for document in documents if document["changelog"]]
+    if states:
+        state = _merge_changelog_states(states)
+        with open(utils.CHANGELOG_STATE_PATH, "w") as f:
+            json.dump(state, f)
+    return sorted(before), sorted(after)
@@ -2,19 +2,29 @@ import argparse
 import json
 import logging
 import os
+import tracemalloc
 from datetime import date, timedelta
 from pathlib import Path
-from shutil import copy, rmtree
-
-import update_cache
-import update_consumer_data
-import update_consumer_stats
-import update_dataset
-import update_package_list
-import update_stats
+from shutil import copy, copytree, rmtree
+
+import metrics
+import negative_cache
+import pipeline
+import release_cache
+import shards
 import utils
 
+# Stage modules are imported by the stages using them, they pull pandas,
+# google-cloud-bigquery, httpx... which are slow to import and not needed
+# by every run.
+
 _LOGGER = logging.getLogger(__name__)
+# stages run for each --only value
+PIPELINES = {
+    "consumer": ("consumer_data", "consumer_stats"),
+    "cache": ("package_list", "cache"),
+    "producer": ("package_list", "cache", "dataset", "producer_stats"),
+}
 
 
 def check_file(value):
@@ -56,17 +66,104 @@ if __name__ == "__main__":
         "-e", "--end", default=default_end, type=date.fromisoformat, help="end date"
     )
     parser.add_argument("--skip-cache", action="store_true", help="skip cache update")
+    parser.add_argument(
+        "--only",
+        action="append",
+        choices=PIPELINES,
+        help="only run the stages of this pipeline, can be repeated. "
+        "The outputs of the other pipelines are kept from the previous build",
+    )
+    shard_group = parser.add_mutually_exclusive_group()
+    shard_group.add_argument(
+        "--shard",
+        type=shards.parse,
+        metavar="I/N",
+        help="only update the cache of the packages of shard I of N and save "
+        "the changes in cache/shards/I-of-N for --merge-shards, implies "
+        "--only cache",
+    )
+    shard_group.add_argument(
+        "--merge-shards",
+        nargs="+",
+        type=Path,
+        metavar="DIR",
+        help="update the cache with the changes saved by all the --shard runs "
+        "rather than from PyPI",
+    )
+    parser.add_argument(
+        "--fetch-concurrency",
+        default=32,
+        type=int,
+        help="maximum number of concurrent requests to PyPI during cache update",
+    )
+    parser.add_argument(
+        "--http2", action="store_true", help="use HTTP/2 during cache update"
+    )
+    parser.add_argument(
+        "--index-url",
+        default=utils.PYPI_URL,
+        help="root of the PyPI JSON API used during cache update",
+    )
+    parser.add_argument(
+        "--update-all",
+        action="store_true",
+        help="update the cache of all packages, packages without recent "
+        "releases are otherwise updated weekly or monthly",
+    )
+    parser.add_argument(
+        "--changelog",
+        action="store_true",
+        help="only update the cache of packages that changed on PyPI since the "
+        "last run",
+    )
+    parser.add_argument(
+        "--changelog-url",
+        default=utils.PYPI_URL,
+        help="PyPI XML-RPC endpoint or JSON file used by --changelog",
+    )
+    parser.add_argument(
+        "--full-update-days",
+        default=7,
+        type=int,
+        help="update the cache of all packages every N days with --changelog",
+    )
+    parser.add_argument(
+        "--cache-backend",
+        default="json",
+        choices=release_cache.BACKENDS,
+        help="storage of the PyPI release info cache",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=os.cpu_count() or 1,
+        type=int,
+        help="number of processes used to build the dataset",
+    )
     parser.add_argument(
         "--bigquery-credentials",
         type=check_file,
         help="path to bigquery credentials (enables bigquery)",
     )
+    parser.add_argument(
+        "--metrics-textfile",
+        type=Path,
+        help="also write the metrics of the run to this Prometheus textfile",
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="record the peak of python allocations of each stage (slower)",
+    )
     parser.add_argument(
         "-v", "--verbosity", action="count", help="increase output verbosity"
     )
     args = parser.parse_args()
 
     logging.basicConfig(level=30 - 10 * min(args.verbosity or 0, 2))
+    if (args.verbosity or 0) < 2:
+        # httpx logs every request at INFO level
+        logging.getLogger("httpx").setLevel(logging.WARNING)
     start = args.start
     end = args.end
     if end > default_end:
@@ -76,24 +173,37 @@ if __name__ == "__main__":
         )
     if start >= end:
         raise ValueError(f"{start} >= {end}")
+    if args.tracemalloc:
+        tracemalloc.start()
 
-    if utils.BUILD_PATH.exists():
-        rmtree(utils.BUILD_PATH)
-    utils.BUILD_PATH.mkdir()
-    utils.CACHE_PATH.mkdir(exist_ok=True)
+    if args.shard is not None:
+        if args.only not in (None, ["cache"]):
+            parser.error("--shard only runs the cache pipeline")
+        args.only = ["cache"]
+    selected = set(PIPELINES["consumer"] + PIPELINES["producer"])
+    if args.only:
+        selected = {stage for only in args.only for stage in PIPELINES[only]}
 
-    _LOGGER.debug("updating consumer data")
-    update_consumer_data.update(
-        utils.ROOT_PATH / "consumer_data", args.bigquery_credentials
-    )
-    update_consumer_stats.update(utils.ROOT_PATH / "consumer_data", start, end)
+    # everything is built in a temporary directory which replaces the
+    # previous build only once all the stages succeeded
+    build_tmp_path = utils.BUILD_PATH.with_name(f"{utils.BUILD_PATH.name}.tmp")
+    if build_tmp_path.exists():
+        rmtree(build_tmp_path)
+    if args.only and utils.BUILD_PATH.exists():
+        copytree(utils.BUILD_PATH, build_tmp_path)
+    build_tmp_path.mkdir(exist_ok=True)
+    utils.CACHE_PATH.mkdir(exist_ok=True)
 
     _LOGGER.debug("loading package list")
     with open(utils.ROOT_PATH / "packages.json") as f:
         packages = json.load(f)
     _LOGGER.debug(f"loaded {len(packages)} package names")
     skip_update_package_list = False
-    if "GITHUB_EVENT_NAME" in os.environ:
+    if args.shard is not None:
+        # all the shards must split the same list
+        _LOGGER.info(f"skip package list update for shard {args.shard}")
+        skip_update_package_list = True
+    elif "GITHUB_EVENT_NAME" in os.environ:
         event_name = os.environ["GITHUB_EVENT_NAME"]
         today = date.today()
         if event_name != "schedule":
@@ -104,22 +214,126 @@ if __name__ == "__main__":
             args.top_packages = True
             args.sethmlarson_pypi_data = True
 
-    if not skip_update_package_list:
-        packages = update_package_list.update(
+    consumer_data_path = utils.ROOT_PATH / "consumer_data"
+    negative = negative_cache.NegativeCache()
+
+    def _update_consumer_data() -> None:
+        import update_consumer_data
+
+        update_consumer_data.update(consumer_data_path, args.bigquery_credentials)
+
+    def _update_consumer_stats(_: None) -> None:
+        import update_consumer_stats
+
+        update_consumer_stats.update(
+            consumer_data_path,
+            start,
+            end,
+            build_tmp_path / utils.CONSUMER_DATA_PATH.name,
+        )
+
+    def _update_package_list() -> list[str]:
+        if skip_update_package_list:
+            return packages
+        import update_package_list
+
+        return update_package_list.update(
             packages,
             args.top_packages,
             args.sethmlarson_pypi_data,
             args.bigquery_credentials,
+            negative,
+        )
+
+    def _update_cache(packages: list[str]) -> list[str]:
+        if args.skip_cache:
+            return packages
+        import update_cache
+
+        return update_cache.update(
+            packages,
+            cache,
+            negative,
+            args.fetch_concurrency,
+            args.http2,
+            args.changelog_url if args.changelog else None,
+            timedelta(days=args.full_update_days),
+            args.update_all,
+            args.index_url,
+            args.shard,
+        )
+
+    def _merge_shards(packages: list[str]) -> list[str]:
+        before, after = shards.merge(args.merge_shards, cache, negative)
+        # packages added to the list since the shards ran aren't in any of them
+        added = sorted(set(packages) - set(before))
+        if added:
+            import update_cache
+
+            _LOGGER.info(f"updating {len(added)} packages not in shards")
+            after = sorted(
+                set(after)
+                | set(
+                    update_cache.update(
+                        added,
+                        cache,
+                        negative,
+                        args.fetch_concurrency,
+                        args.http2,
+                        update_all=True,
+                        index_url=args.index_url,
+                    )
+                )
+            )
+        return after
+
+    def _update_dataset(packages: list[str]) -> tuple[list[str], list[utils.Row]]:
+        import update_dataset
+
+        return update_dataset.update(packages, cache, args.jobs)
+
+    def _update_producer_stats(dataset: tuple[list[str], list[utils.Row]]) -> None:
+        import update_stats
+
+        update_stats.update(
+            dataset[1], start, end, build_tmp_path / utils.PRODUCER_DATA_PATH.name
         )
 
-    if not args.skip_cache:
-        packages = update_cache.update(packages)
-    packages, rows = update_dataset.update(packages)
-    with open(utils.ROOT_PATH / "packages.json", "w") as f:
-        json.dump(packages, f, indent=0)
-        f.write("\n")
-    update_stats.update(rows, start, end)
-    copy(utils.ROOT_PATH / "index.html", utils.BUILD_PATH)
-    copy(utils.ROOT_PATH / "style.css", utils.BUILD_PATH)
-    copy(utils.ROOT_PATH / "favicon.ico", utils.BUILD_PATH)
-    copy(utils.ROOT_PATH / ".gitignore", utils.BUILD_PATH)
+    # the consumer pipeline (BigQuery, pandas) and the producer one (PyPI,
+    # release info) share nothing and run concurrently
+    stages = [
+        pipeline.Stage("consumer_data", _update_consumer_data),
+        pipeline.Stage("consumer_stats", _update_consumer_stats, ("consumer_data",)),
+        pipeline.Stage("package_list", _update_package_list),
+        pipeline.Stage(
+            "cache",
+            _merge_shards if args.merge_shards else _update_cache,
+            ("package_list",),
+        ),
+        pipeline.Stage("dataset", _update_dataset, ("cache",)),
+        pipeline.Stage("producer_stats", _update_producer_stats, ("dataset",)),
+    ]
+    with release_cache.open_cache(args.cache_backend) as cache:
+        try:
+            outputs = pipeline.run(
+                [stage for stage in stages if stage.name in selected]
+            )
+        finally:
+            metrics.write(build_tmp_path / utils.METRICS_PATH.name)
+            if args.metrics_textfile is not None:
+                metrics.write_prometheus(args.metrics_textfile)
+    # shards only save their changes, merged by --merge-shards
+    if "cache" in outputs and args.shard is None:
+        negative.save()
+        # packages without rows are dropped by the dataset
+        packages = outputs["dataset"][0] if "dataset" in outputs else outputs["cache"]
+        with open(utils.ROOT_PATH / "packages.json", "w") as f:
+            json.dump(packages, f, indent=0)
+            f.write("\n")
+    copy(utils.ROOT_PATH / "index.html", build_tmp_path)
+    copy(utils.ROOT_PATH / "style.css", build_tmp_path)
+    copy(utils.ROOT_PATH / "favicon.ico", build_tmp_path)
+    copy(utils.ROOT_PATH / ".gitignore", build_tmp_path)
+    if utils.BUILD_PATH.exists():
+        rmtree(utils.BUILD_PATH)
+    build_tmp_path.rename(utils.BUILD_PATH)
@@ -1,18 +1,52 @@
+import asyncio
+import email.utils
+import hashlib
+import http.client
 import json
 import logging
+import random
+import time
 import urllib.parse
+import xmlrpc.client
+from collections.abc import Iterable
 from dataclasses import dataclass
-from datetime import date, datetime
+from datetime import date, datetime, timedelta, timezone
 from enum import Enum
-from multiprocessing.pool import ThreadPool
 from pathlib import Path
-from shutil import move
+from typing import Any, cast
 
-import requests
+import httpx
+import ijson
+from packaging.utils import canonicalize_name
 
+import metrics
+import negative_cache
+import release_cache
+import shards
 import utils
 
 _LOGGER = logging.getLogger(__name__)
+_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+_MAX_ATTEMPTS = 5
+_RETRY_DELAY = 1.0  # seconds, doubled on each attempt
+_MAX_RETRY_DELAY = 60.0
+_DECREASE_INTERVAL = 1.0
+# (age of the newest release, update period in days)
+_REFRESH_TIERS = (
+    (timedelta(days=31), 1),
+    (timedelta(days=365), 7),
+)
+_REFRESH_PERIOD_DORMANT = 30
+# the changelog endpoint can fail or a stand-in feed be missing or corrupt,
+# all packages are updated then
+_CHANGELOG_ERRORS = (
+    xmlrpc.client.Error,
+    http.client.HTTPException,
+    OSError,
+    ValueError,
+    LookupError,
+)
 
 
 class Status(Enum):
@@ -26,30 +60,234 @@ class Status(Enum):
 class PackageStatus:
     name: str
     status: Status
+    elapsed: float = 0.0  # seconds spent on the package, retries included
 
 
-def _build_url(package: str) -> str:
-    return f"https://pypi.org/pypi/{package}/json"
+def _build_url(index_url: str, package: str) -> str:
+    return f"{index_url}/{package}/json"
 
 
-def _package_update(package: str, handle_moved: bool = False) -> PackageStatus:
+class _Limiter:
+    # AIMD limit on the number of requests in flight: +1 for each window of
+    # successful requests, halved when PyPI throttles us or has trouble
+
+    def __init__(self, max_limit: int) -> None:
+        self._max_limit = max_limit
+        self._limit = float(max_limit)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < int(self._limit))
+            self._in_flight += 1
+
+    async def release(self, congested: bool) -> None:
+        async with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if not congested:
+                self._limit = min(self._max_limit, self._limit + 1 / self._limit)
+            elif now - self._last_decrease > _DECREASE_INTERVAL:
+                # requests in flight when congestion starts will likely fail
+                # as well, only react once for all of them
+                self._last_decrease = now
+                self._limit = max(1.0, self._limit / 2)
+                _LOGGER.info(f"congestion, limiting to {int(self._limit)} requests")
+            self._condition.notify_all()
+
+
+def _get_retry_after(response: httpx.Response) -> float | None:
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return (when - datetime.now(timezone.utc)).total_seconds()
+
+
+def _get_retry_delay(response: httpx.Response | None, attempt: int) -> float:
+    delay = None if response is None else _get_retry_after(response)
+    if delay is None:
+        # exponential backoff with jitter so that workers don't retry in sync
+        delay = _RETRY_DELAY * 2**attempt * random.uniform(0.5, 1.0)
+    return min(max(delay, 0.0), _MAX_RETRY_DELAY)
+
+
+async def _get(
+    client: httpx.AsyncClient, limiter: _Limiter, url: str, headers: dict[str, str]
+) -> httpx.Response:
+    # retries on connection errors, throttling and server errors
+    attempt = 0
+    while True:
+        attempt += 1
+        last_attempt = attempt == _MAX_ATTEMPTS
+        response = None
+        await limiter.acquire()
+        try:
+            request = client.build_request("GET", url, headers=headers)
+            response = await client.send(request, stream=True)
+        except httpx.RequestError as e:
+            # too many redirects or a response that can't be decoded aren't
+            # a sign of congestion, they are retried all the same
+            metrics.count("transport_errors")
+            await limiter.release(congested=isinstance(e, httpx.TransportError))
+            if last_attempt:
+                raise
+            error = repr(e)
+        else:
+            for response_ in (*response.history, response):
+                metrics.count(f"responses_{response_.status_code}")
+            congested = response.status_code in _RETRY_STATUS_CODES
+            if not congested or last_attempt:
+                # the caller reads the body, closes the response and releases
+                # the limiter, the body is part of the request in flight
+                return response
+            await response.aclose()
+            await limiter.release(congested)
+            error = f"{response.status_code} {response.reason_phrase}"
+        delay = _get_retry_delay(response, attempt - 1)
+        _LOGGER.debug(f'"{url}": error "{error}", retrying in {delay:.1f}s')
+        await asyncio.sleep(delay)
+
+
+class _ReleaseFilter:
+    # keeps what we need of "releases" while the JSON document is parsed:
+    # the first upload date of each release and its manylinux wheels
+
+    def __init__(self, package: str) -> None:
+        self.releases: dict[str, tuple[str, list[str]]] = {}
+        self._package = package
+        self._events = ijson.sendable_list()
+        self._parser = ijson.parse_coro(self._events)
+        self._version: str | None = None
+        self._prefix = ""
+        self._upload_date = date.max
+        self._filenames: list[str] = []
+        self._file: dict[str, str] = {}
+
+    def feed(self, data: bytes) -> None:
+        self._parser.send(data)
+        self._process()
+
+    def close(self) -> None:
+        self._parser.close()
+        self._process()
+
+    def _process(self) -> None:
+        for prefix, event, value in self._events:
+            if prefix == "releases":
+                if event == "map_key":
+                    self._start_release(value)
+                elif event == "end_map":
+                    self._end_release()
+            elif self._version is None or not prefix.startswith(self._prefix):
+                continue
+            elif prefix == self._prefix:
+                if event == "end_map":
+                    self._end_file()
+            elif event == "string" and prefix in (
+                f"{self._prefix}.filename",
+                f"{self._prefix}.upload_time",
+            ):
+                self._file[prefix.rpartition(".")[2]] = value
+        del self._events[:]
+
+    def _start_release(self, version: str) -> None:
+        self._end_release()
+        self._version = version
+        self._prefix = f"releases.{version}.item"
+        self._upload_date = date.max
+        self._filenames = []
+
+    def _end_release(self) -> None:
+        if self._version is not None and len(self._filenames) > 0:
+            self.releases[self._version] = (
+                self._upload_date.isoformat(),
+                self._filenames,
+            )
+        self._version = None
+
+    def _end_file(self) -> None:
+        file, self._file = self._file, {}
+        upload_date = datetime.fromisoformat(file["upload_time"]).date()
+        self._upload_date = min(self._upload_date, upload_date)
+        filename = file["filename"]
+        if not filename.lower().endswith(".whl"):
+            return
+        metadata = utils.parse_wheel_filename(filename)
+        if metadata is None:
+            _LOGGER.warning(f'"{self._package}":invalid wheel name "{filename}"')
+            return  # invalid name
+        if "manylinux" not in metadata.platform:
+            return
+        self._filenames.append(filename)
+
+
+async def _read_releases(
+    package: str, response: httpx.Response
+) -> dict[str, tuple[str, list[str]]]:
+    # the document is parsed as it's received, it can be several MB for
+    # projects with a lot of releases and most of it is of no use here
+    release_filter = _ReleaseFilter(package)
+    async for data in response.aiter_bytes():
+        release_filter.feed(data)
+    release_filter.close()
+    return release_filter.releases
+
+
+async def _package_update(
+    client: httpx.AsyncClient,
+    limiter: _Limiter,
+    cache: release_cache.ReleaseCache,
+    package: str,
+    index_url: str,
+    handle_moved: bool = False,
+) -> PackageStatus:
     _LOGGER.info(f'"{package}": begin update')
-    headers = {"User-Agent": utils.USER_AGENT}
-    package_new_name = package
-    cache_file = utils.get_release_cache_path(package)
-    if cache_file.exists():
-        with open(cache_file) as f:
-            info = json.load(f)
-            headers["If-None-Match"] = info["etag"]
-    response = requests.get(_build_url(package), headers=headers)
+    headers: dict[str, str] = {}
+    etag = cache.get_etag(package)
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    try:
+        url = _build_url(index_url, package)
+        response = await _get(client, limiter, url, headers)
+    except httpx.RequestError as e:
+        _LOGGER.error(f'"{package}": error "{e!r}" when retrieving info')
+        return PackageStatus(package, Status.ERROR)
     try:
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as e:
+        return await _process_response(
+            cache, package, response, index_url, handle_moved
+        )
+    finally:
+        await response.aclose()
+        await limiter.release(response.status_code in _RETRY_STATUS_CODES)
+
+
+async def _process_response(
+    cache: release_cache.ReleaseCache,
+    package: str,
+    response: httpx.Response,
+    index_url: str,
+    handle_moved: bool,
+) -> PackageStatus:
+    package_new_name = package
+    if response.is_error:
         if response.status_code == 404:
             _LOGGER.warning(f'"{package}": not available on PyPI anymore')
             return PackageStatus(package, Status.REMOVED)
         else:
-            _LOGGER.error(f'"{package}": error "{e}" when retrieving info')
+            error = f"{response.status_code} {response.reason_phrase}"
+            _LOGGER.error(f'"{package}": error "{error}" when retrieving info')
             return PackageStatus(package, Status.ERROR)
     for response_prev in response.history[::-1]:
         if response_prev.status_code == 301:
@@ -58,7 +296,7 @@ def _package_update(package: str, handle_moved: bool = False) -> PackageStatus:
             new_location = response_prev.headers["location"]
             uri = urllib.parse.urlparse(new_location)
             package_new_name = Path(uri.path).parent.name
-            if _build_url(package_new_name) != new_location:
+            if _build_url(index_url, package_new_name) != new_location:
                 _LOGGER.warning(f'"{package}": unsupported relocation')
                 package_new_name = package
             else:
@@ -67,70 +305,326 @@ def _package_update(package: str, handle_moved: bool = False) -> PackageStatus:
 
     if response.status_code == 304:
         if package_new_name != package:
-            cache_file_new = utils.get_release_cache_path(package_new_name)
-            move(cache_file, cache_file_new)
+            cache.move(package, package_new_name)
         return PackageStatus(package_new_name, Status.PROCESSED)
-    elif package_new_name != package:
-        cache_file = utils.get_release_cache_path(package_new_name)
-
-    info = response.json()
-    # add 'etag' and filter-out what we don't need
-    info = {"etag": response.headers["etag"], "releases": info["releases"]}
-    for release in list(info["releases"]):
-        new_files = []
-        upload_date_min = date.max
-        for file in info["releases"][release]:
-            upload_date = datetime.fromisoformat(file["upload_time"]).date()
-            upload_date_min = min(upload_date_min, upload_date)
-            filename = file["filename"]
-            if not filename.lower().endswith(".whl"):
-                continue
-            parsed_filename = utils.WHEEL_INFO_RE.match(filename)
-            if parsed_filename is None:
-                _LOGGER.warning(f'"{package}":invalid wheel name "{filename}"')
-                continue  # invalid name
-            metadata = utils.WheelMetadata(*parsed_filename.groups()[1:])
-            if "manylinux" not in metadata.platform:
-                continue
-            new_files.append(
-                {"filename": filename, "upload_time": upload_date.isoformat()}
-            )
 
-        if len(new_files) > 0:
-            new_files.insert(
-                0, {"filename": "ut-1.zip", "upload_time": upload_date_min.isoformat()}
-            )
-            info["releases"][release] = new_files
-        else:
-            info["releases"].pop(release)
-    with open(cache_file, "w") as f:
-        json.dump(info, f)
+    # filter-out what we don't need and summarize what's left for update_dataset
+    try:
+        releases = await _read_releases(package, response)
+    except (httpx.RequestError, ijson.JSONError) as e:
+        _LOGGER.error(f'"{package}": error "{e!r}" when retrieving info')
+        return PackageStatus(package, Status.ERROR)
+    metrics.count("bytes_downloaded", response.num_bytes_downloaded)
+    info = {
+        "etag": response.headers["etag"],
+        "releases": release_cache.summarize(package_new_name, releases),
+    }
+    cache.put(package_new_name, info)
     return PackageStatus(package_new_name, Status.PROCESSED)
 
 
-def update(packages: list[str]) -> list[str]:
-    utils.RELEASE_INFO_PATH.mkdir(exist_ok=True)
-    packages_set = set(packages)
-    to_remove = set()
-    to_add = set()
+def _create_client(concurrency: int, http2: bool) -> httpx.AsyncClient:
+    # a single client shares its keep-alive connection pool between all the
+    # requests so that we only pay for the TCP+TLS handshake once per connection
+    limits = httpx.Limits(
+        max_connections=concurrency, max_keepalive_connections=concurrency
+    )
+    return httpx.AsyncClient(
+        headers={"User-Agent": utils.USER_AGENT},
+        follow_redirects=True,
+        http2=http2,
+        limits=limits,
+        timeout=_TIMEOUT,
+    )
+
+
+async def _package_update_all(
+    client: httpx.AsyncClient,
+    limiter: _Limiter,
+    cache: release_cache.ReleaseCache,
+    packages: Iterable[str],
+    concurrency: int,
+    index_url: str = utils.PYPI_URL,
+    handle_moved: bool = False,
+) -> dict[str, PackageStatus]:
+    pending = iter(packages)
+    results: dict[str, PackageStatus] = {}
+
+    async def _worker() -> None:
+        # all workers pull from the same iterator, this bounds the number of
+        # requests in flight without creating one task per package upfront
+        for package in pending:
+            start = time.monotonic()
+            package_status = await _package_update(
+                client, limiter, cache, package, index_url, handle_moved
+            )
+            package_status.elapsed = time.monotonic() - start
+            results[package] = package_status
+
+    await asyncio.gather(*(_worker() for _ in range(concurrency)))
+    return results
+
+
+async def _update(
+    packages: list[str],
+    cache: release_cache.ReleaseCache,
+    concurrency: int,
+    http2: bool,
+    negative: negative_cache.NegativeCache,
+    index_url: str,
+) -> tuple[set[str], dict[str, str], set[str]]:
+    # returns the packages removed from PyPI, moved ones with their new name
+    # and the ones that failed
+    removed = set()
+    moved = {}
     to_reprocess = set()
+    failed = set()
 
-    with ThreadPool(32) as pool:
-        for package_status in pool.imap(_package_update, sorted(packages), chunksize=1):
+    limiter = _Limiter(concurrency)
+    async with _create_client(concurrency, http2) as client:
+        results = await _package_update_all(
+            client, limiter, cache, sorted(packages), concurrency, index_url
+        )
+        for package_status in results.values():
             if package_status.status == Status.PROCESSED:
                 pass
             elif package_status.status == Status.REMOVED:
-                to_remove.add(package_status.name)
+                removed.add(package_status.name)
+                negative.add(package_status.name, "removed")
             else:
                 assert package_status.status in {Status.MOVED, Status.ERROR}
                 to_reprocess.add(package_status.name)
 
-    for package in sorted(to_reprocess):
-        package_status = _package_update(package, handle_moved=True)
-        if package_status.status == Status.REMOVED:
-            to_remove.add(package_status.name)
-        elif package_status.name != package:
-            to_remove.add(package)
-            to_add.add(package_status.name)
+        results = await _package_update_all(
+            client,
+            limiter,
+            cache,
+            sorted(to_reprocess),
+            concurrency,
+            index_url,
+            handle_moved=True,
+        )
+        for package, package_status in sorted(results.items()):
+            if package_status.status == Status.REMOVED:
+                removed.add(package_status.name)
+                negative.add(package_status.name, "removed")
+            elif package_status.status == Status.ERROR:
+                failed.add(package)
+            elif package_status.name != package:
+                moved[package] = package_status.name
+
+    return removed, moved, failed
+
+
+def _get_changelog_proxy(changelog_url: str) -> xmlrpc.client.ServerProxy:
+    return xmlrpc.client.ServerProxy(
+        changelog_url, headers=[("User-Agent", utils.USER_AGENT)]
+    )
+
+
+def _get_last_serial(changelog_url: str) -> int:
+    if not changelog_url.startswith(("http://", "https://")):
+        # local stand-in feed, a JSON list of [name, version, timestamp,
+        # action, serial] as returned by changelog_since_serial
+        with open(changelog_url) as f:
+            return max((event[4] for event in json.load(f)), default=0)
+    return cast(int, _get_changelog_proxy(changelog_url).changelog_last_serial())
+
+
+def _get_changelog(changelog_url: str, serial: int) -> list[list[Any]]:
+    if not changelog_url.startswith(("http://", "https://")):
+        with open(changelog_url) as f:
+            return [event for event in json.load(f) if event[4] > serial]
+    proxy = _get_changelog_proxy(changelog_url)
+    events: list[list[Any]] = []
+    # PyPI limits the number of events returned at once
+    while batch := cast(list[list[Any]], proxy.changelog_since_serial(serial)):
+        events.extend(batch)
+        serial = max(event[4] for event in batch)
+    return events
+
+
+def _load_changelog_state() -> dict[str, Any] | None:
+    if not utils.CHANGELOG_STATE_PATH.exists():
+        return None
+    with open(utils.CHANGELOG_STATE_PATH) as f:
+        return dict(json.load(f))
 
-    return list(sorted((packages_set - to_remove) | to_add))
+
+def _save_changelog_state(state: dict[str, Any]) -> None:
+    with open(utils.CHANGELOG_STATE_PATH, "w") as f:
+        json.dump(state, f)
+
+
+def _get_changed_packages(
+    packages: list[str],
+    cache: release_cache.ReleaseCache,
+    state: dict[str, Any],
+    changelog_url: str,
+) -> tuple[list[str], int]:
+    events = _get_changelog(changelog_url, state["serial"])
+    serial = max((event[4] for event in events), default=state["serial"])
+    changed = {canonicalize_name(event[0]) for event in events}
+    # packages not in cache yet & packages that failed last time
+    in_cache = cache.get_stamps(packages)
+    pending = set(state["pending"])
+    result = [
+        package
+        for package in packages
+        if canonicalize_name(package) in changed
+        or package not in in_cache
+        or package in pending
+    ]
+    _LOGGER.info(
+        f"changelog: {len(events)} events since serial {state['serial']}, "
+        f"updating {len(result)} packages"
+    )
+    return result, serial
+
+
+def _get_refresh_period(last_upload: date | None, today: date) -> int:
+    if last_upload is None:
+        return 1
+    for age, period in _REFRESH_TIERS:
+        if today - last_upload <= age:
+            return period
+    return _REFRESH_PERIOD_DORMANT
+
+
+def _is_refresh_due(package: str, period: int, today: date) -> bool:
+    # spread the packages of a tier over its period, using a hash rather than
+    # hash() which is salted differently in each process
+    digest = hashlib.sha256(canonicalize_name(package).encode()).digest()
+    jitter = int.from_bytes(digest[:4], "little")
+    return (today.toordinal() + jitter) % period == 0
+
+
+def _get_scheduled_packages(
+    packages: list[str], cache: release_cache.ReleaseCache, today: date
+) -> list[str]:
+    last_uploads = cache.get_last_uploads(packages)
+    result = [
+        package
+        for package in packages
+        if _is_refresh_due(
+            package, _get_refresh_period(last_uploads.get(package), today), today
+        )
+    ]
+    _LOGGER.info(f"scheduler: updating {len(result)} of {len(packages)} packages")
+    return result
+
+
+def _update_negative_cache(
+    packages: Iterable[str],
+    cache: release_cache.ReleaseCache,
+    negative: negative_cache.NegativeCache,
+) -> None:
+    # the row criteria of update_dataset, without the version filtering
+    for package, raw_info in cache.iter_raw(packages):
+        releases = json.loads(raw_info)["releases"]
+        if not releases:
+            negative.add(package, "no-manylinux")
+        elif not any(python and manylinux for _, _, python, manylinux in releases):
+            negative.add(package, "invalid")
+        else:
+            negative.discard(package)
+
+
+def _skip_negative(
+    packages: list[str], negative: negative_cache.NegativeCache
+) -> list[str]:
+    # packages known to be useless are not worth a request, unless the
+    # changelog says they changed
+    result = [package for package in packages if package not in negative]
+    if len(result) != len(packages):
+        _LOGGER.info(f"skipping {len(packages) - len(result)} useless packages")
+    return result
+
+
+def update(
+    packages: list[str],
+    cache: release_cache.ReleaseCache,
+    negative: negative_cache.NegativeCache,
+    concurrency: int = 32,
+    http2: bool = False,
+    changelog_url: str | None = None,
+    full_update_interval: timedelta = timedelta(days=7),
+    update_all: bool = False,
+    index_url: str = utils.PYPI_URL,
+    shard: shards.Shard | None = None,
+) -> list[str]:
+    # with a changelog_url, only packages that changed on PyPI since the last
+    # run are updated, all packages are still updated every
+    # full_update_interval in case we missed something.
+    # Otherwise, packages without recent releases are updated less often.
+    # Packages in the negative cache are skipped in both cases.
+    # With a shard, only the packages of that shard are considered, those are
+    # the ones returned, and the changes are saved for shards.merge.
+    if shard is not None:
+        packages = [package for package in packages if package in shard]
+        _LOGGER.info(f"shard {shard}: {len(packages)} packages")
+    to_update = packages
+    state = None
+    if update_all:
+        _LOGGER.info("updating all packages")
+    elif changelog_url is None:
+        to_update = _get_scheduled_packages(packages, cache, date.today())
+        to_update = _skip_negative(to_update, negative)
+    else:
+        today = date.today()
+        state = _load_changelog_state()
+        try:
+            if (
+                state is None
+                or state["url"] != changelog_url
+                or today - date.fromisoformat(state["full_update"])
+                >= full_update_interval
+            ):
+                # get the serial first, events that happen while we're
+                # updating will be processed again next time
+                state = {
+                    "url": changelog_url,
+                    "serial": _get_last_serial(changelog_url),
+                    "full_update": today.isoformat(),
+                }
+                _LOGGER.info(f"changelog: full update at serial {state['serial']}")
+                to_update = _skip_negative(to_update, negative)
+            else:
+                to_update, state["serial"] = _get_changed_packages(
+                    packages, cache, state, changelog_url
+                )
+        except _CHANGELOG_ERRORS as e:
+            # the state is left as is, the changelog is read again next time
+            _LOGGER.warning(f"changelog: {e!r}, full update")
+            state = None
+            to_update = _skip_negative(packages, negative)
+    # shards only save the info that changes
+    stamps = cache.get_stamps(to_update) if shard is not None else {}
+    metrics.count("packages_checked", len(to_update))
+    metrics.count("packages_skipped", len(packages) - len(to_update))
+    removed, moved, failed = asyncio.run(
+        _update(to_update, cache, concurrency, http2, negative, index_url)
+    )
+    to_remove = removed | set(moved)
+    to_add = set(moved.values())
+    _update_negative_cache(
+        (set(to_update) - to_remove - failed) | to_add, cache, negative
+    )
+    metrics.count("packages_failed", len(failed))
+    if state is not None:
+        state["pending"] = sorted(failed)
+        _save_changelog_state(state)
+    if shard is not None:
+        shards.save(
+            shard,
+            packages,
+            to_update,
+            removed,
+            moved,
+            failed,
+            cache,
+            negative,
+            state,
+            stamps,
+        )
+    return list(sorted((set(packages) - to_remove) | to_add))
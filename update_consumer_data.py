@@ -5,14 +5,15 @@ from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
-from google.api_core.exceptions import Forbidden, GoogleAPIError
-from google.cloud import bigquery
-
 _LOGGER = logging.getLogger(__name__)
 BIGQUERY_TOKEN = "BIGQUERY_TOKEN"
 
 
 def _update_consumer_data(path: Path, bigquery_credentials: Path | None) -> None:
+    # imported here, most runs don't query BigQuery
+    from google.api_core.exceptions import Forbidden, GoogleAPIError
+    from google.cloud import bigquery
+
     today = datetime.fromisocalendar(*datetime.now(timezone.utc).isocalendar())
     table_suffix = (today - timedelta(days=1)).strftime("%Y-%m-%d")
     # table_suffix = "2022-08-19"
@@ -1,177 +1,124 @@
+import hashlib
 import json
-from datetime import datetime, timedelta, timezone
+import logging
+from collections.abc import Iterable
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
 from typing import Any, Union
 
 import numpy as np
 import pandas as pd
-from packaging.version import InvalidVersion, Version
 
+import artifacts
+import consumer_store
 import utils
 
-POLICIES = {
-    0: "none",
-    1: "manylinux1",
-    2: "manylinux2010",
-    3: "manylinux2014",
-    4: "manylinux_2_17",
-    5: "manylinux_2_19",
-    6: "manylinux_2_23",
-    7: "manylinux_2_24",
-    8: "manylinux_2_26",
-    9: "manylinux_2_27",
-    10: "manylinux_2_28",
-    11: "manylinux_2_31",
-    12: "manylinux_2_34",
-    13: "manylinux_2_35",
-}
-
-
-def _get_major_minor(x):
-    try:
-        version = Version(x)
-    except InvalidVersion:
-        return "0.0"
-    if version.major > 50:
-        return "0.0"  # invalid version
-    return f"{version.major}.{version.minor}"
-
-
-def _load_df(path: Path, date: datetime) -> pd.DataFrame | None:
-    folder = path / date.strftime("%Y") / date.strftime("%m")
-    file = folder / f"{date.strftime('%d')}.csv"
-    if not file.exists():
-        return None
-    df = pd.read_csv(
-        file,
-        converters={
-            "python_version": lambda x: _get_major_minor(x),
-            "pip_version": lambda x: _get_major_minor(x),
-            "glibc_version": lambda x: _get_major_minor(x),
-        },
-    )
-    df["day"] = pd.to_datetime(date)
-    return df
+_LOGGER = logging.getLogger(__name__)
+# bump when the content of the persisted state changes
+_STATE_VERSION = 1
+# bump when the output changes for the same inputs
+_OUTPUT_VERSION = 1
+_KEYS = ["day", "python_version", "glibc_version", "policy"]
+# minimum pip and glibc versions required to install wheels of each policy,
+# from oldest to newest. A policy is only supported if all the previous ones
+# are, i.e. both columns must be sorted.
+POLICY_TABLE = (
+    ("manylinux1", "8.1", "2.5"),
+    ("manylinux2010", "19.0", "2.12"),
+    ("manylinux2014", "19.3", "2.17"),
+    ("manylinux_2_17", "20.3", "2.17"),
+    ("manylinux_2_19", "20.3", "2.19"),
+    ("manylinux_2_23", "20.3", "2.23"),
+    ("manylinux_2_24", "20.3", "2.24"),
+    ("manylinux_2_26", "20.3", "2.26"),
+    ("manylinux_2_27", "20.3", "2.27"),
+    ("manylinux_2_28", "20.3", "2.28"),
+    ("manylinux_2_31", "20.3", "2.31"),
+    ("manylinux_2_34", "20.3", "2.34"),
+    ("manylinux_2_35", "20.3", "2.35"),
+)
+POLICIES = ("none",) + tuple(policy for policy, _, _ in POLICY_TABLE)
 
 
-def update(path: Path, start: datetime, end: datetime):
-    date_ = start - utils.CONSUMER_WINDOW_SIZE
-    dataframes = []
-    while date_ < end:
-        df = _load_df(path, date_)
-        if df is not None:
-            dataframes.append(df)
-        date_ = date_ + timedelta(days=1)
-
-    df = pd.concat(dataframes)
-
-    pip_version = df["pip_version"].str.split(".", n=2, expand=True)
-    df["pip_major"] = pd.to_numeric(pip_version[0])
-    df["pip_minor"] = pd.to_numeric(pip_version[1])
-    glibc_version = df["glibc_version"].str.split(".", n=2, expand=True)
-    df["glibc_major"] = pd.to_numeric(glibc_version[0])
-    df["glibc_minor"] = pd.to_numeric(glibc_version[1])
-    df["manylinux1"] = (
-        ((df.pip_major > 8) | ((df.pip_major == 8) & (df.pip_minor >= 1)))
-        & ((df.glibc_major > 2) | ((df.glibc_major == 2) & (df.glibc_minor >= 5)))
-    ).astype(int)
-    df["manylinux2010"] = (
-        ((df.pip_major > 19) | ((df.pip_major == 19) & (df.pip_minor >= 0)))
-        & ((df.glibc_major > 2) | ((df.glibc_major == 2) & (df.glibc_minor >= 12)))
-    ).astype(int)
-    df["manylinux2014"] = (
-        ((df.pip_major > 19) | ((df.pip_major == 19) & (df.pip_minor >= 3)))
-        & ((df.glibc_major > 2) | ((df.glibc_major == 2) & (df.glibc_minor >= 17)))
-    ).astype(int)
-    df["manylinux_2_17"] = (
-        ((df.pip_major > 20) | ((df.pip_major == 20) & (df.pip_minor >= 3)))
-        & ((df.glibc_major > 2) | ((df.glibc_major == 2) & (df.glibc_minor >= 17)))
-    ).astype(int)
-    df["manylinux_2_19"] = (
-        ((df.pip_major > 20) | ((df.pip_major == 20) & (df.pip_minor >= 3)))
-        & ((df.glibc_major > 2) | ((df.glibc_major == 2) & (df.glibc_minor >= 19)))
-    ).astype(int)
-    df["manylinux_2_23"] = (
-        ((df.pip_major > 20) | ((df.pip_major == 20) & (df.pip_minor >= 3)))
-        & ((df.glibc_major > 2) | ((df.glibc_major == 2) & (df.glibc_minor >= 23)))
-    ).astype(int)
-    df["manylinux_2_24"] = (
-        ((df.pip_major > 20) | ((df.pip_major == 20) & (df.pip_minor >= 3)))
-        & ((df.glibc_major > 2) | ((df.glibc_major == 2) & (df.glibc_minor >= 24)))
-    ).astype(int)
-    df["manylinux_2_26"] = (
-        ((df.pip_major > 20) | ((df.pip_major == 20) & (df.pip_minor >= 3)))
-        & ((df.glibc_major > 2) | ((df.glibc_major == 2) & (df.glibc_minor >= 26)))
-    ).astype(int)
-    df["manylinux_2_27"] = (
-        ((df.pip_major > 20) | ((df.pip_major == 20) & (df.pip_minor >= 3)))
-        & ((df.glibc_major > 2) | ((df.glibc_major == 2) & (df.glibc_minor >= 27)))
-    ).astype(int)
-    df["manylinux_2_28"] = (
-        ((df.pip_major > 20) | ((df.pip_major == 20) & (df.pip_minor >= 3)))
-        & ((df.glibc_major > 2) | ((df.glibc_major == 2) & (df.glibc_minor >= 28)))
-    ).astype(int)
-    df["manylinux_2_31"] = (
-        ((df.pip_major > 20) | ((df.pip_major == 20) & (df.pip_minor >= 3)))
-        & ((df.glibc_major > 2) | ((df.glibc_major == 2) & (df.glibc_minor >= 31)))
-    ).astype(int)
-    df["manylinux_2_34"] = (
-        ((df.pip_major > 20) | ((df.pip_major == 20) & (df.pip_minor >= 3)))
-        & ((df.glibc_major > 2) | ((df.glibc_major == 2) & (df.glibc_minor >= 34)))
-    ).astype(int)
-    df["manylinux_2_35"] = (
-        ((df.pip_major > 20) | ((df.pip_major == 20) & (df.pip_minor >= 3)))
-        & ((df.glibc_major > 2) | ((df.glibc_major == 2) & (df.glibc_minor >= 35)))
-    ).astype(int)
-    df["policy"] = (
-        df["manylinux1"]
-        + df["manylinux2010"]
-        + df["manylinux2014"]
-        + df["manylinux_2_17"]
-        + df["manylinux_2_19"]
-        + df["manylinux_2_23"]
-        + df["manylinux_2_24"]
-        + df["manylinux_2_26"]
-        + df["manylinux_2_27"]
-        + df["manylinux_2_28"]
-        + df["manylinux_2_31"]
-        + df["manylinux_2_34"]
-        + df["manylinux_2_35"]
+def _encode_versions(versions: Iterable[str]) -> np.ndarray:
+    # "major.minor" -> sortable integer
+    result = []
+    for version in versions:
+        major, minor = version.split(".")
+        result.append(int(major) * 1000 + int(minor))
+    return np.array(result, dtype=np.int64)
+
+
+_PIP_THRESHOLDS = _encode_versions(pip for _, pip, _ in POLICY_TABLE)
+_GLIBC_THRESHOLDS = _encode_versions(glibc for _, _, glibc in POLICY_TABLE)
+assert np.all(np.diff(_PIP_THRESHOLDS) >= 0) and np.all(np.diff(_GLIBC_THRESHOLDS) >= 0)
+
+
+def _get_policy(pip_version: pd.Series, glibc_version: pd.Series) -> np.ndarray:
+    # index in POLICIES of the newest policy supported by each pip/glibc pair,
+    # versions are only encoded once per unique value
+    pip_codes, pip_uniques = pd.factorize(pip_version)
+    glibc_codes, glibc_uniques = pd.factorize(glibc_version)
+    pip = _encode_versions(pip_uniques)[pip_codes]
+    glibc = _encode_versions(glibc_uniques)[glibc_codes]
+    return np.minimum(
+        np.searchsorted(_PIP_THRESHOLDS, pip, side="right"),
+        np.searchsorted(_GLIBC_THRESHOLDS, glibc, side="right"),
     )
-    df.drop(
-        columns=[
-            "pip_version",
-            "pip_major",
-            "pip_minor",
-            "glibc_major",
-            "glibc_minor",
-            "manylinux1",
-            "manylinux2010",
-            "manylinux2014",
-            "manylinux_2_17",
-            "manylinux_2_19",
-            "manylinux_2_23",
-            "manylinux_2_24",
-            "manylinux_2_26",
-            "manylinux_2_27",
-            "manylinux_2_28",
-            "manylinux_2_31",
-            "manylinux_2_34",
-            "manylinux_2_35",
-        ],
-        inplace=True,
+
+
+def _to_percent(values: np.ndarray, ndigits: int) -> list[float]:
+    # same as float(f"{100.0 * value:.{ndigits}f}") for each value, the few
+    # values too close to a tie for np.round to be trusted are formatted
+    values = 100.0 * values
+    result = np.round(values, ndigits)
+    scaled = values * 10**ndigits
+    for i in np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6):
+        result[i] = float(f"{values[i]:.{ndigits}f}")
+    return result.tolist()
+
+
+def _get_shares(df: pd.DataFrame, index: pd.DatetimeIndex, column: str):
+    # day x `column` share of downloads, 0.0 for days without downloads
+    counts = (
+        df.groupby(["day", column])["num_downloads"]
+        .sum()
+        .unstack(column, fill_value=0.0)
     )
+    shares = counts.div(counts.sum(axis=1), axis=0)
+    return shares.reindex(index=index, fill_value=0.0)
+
+
+def _get_stats(
+    shares: pd.DataFrame, groups: dict[str, tuple], ndigits: int
+) -> dict[str, list[str] | list[float]]:
+    # sum of the shares of each group of columns
+    stats = dict[str, Union[list[str], list[float]]]()
+    stats["keys"] = list(groups)
+    for key, columns in groups.items():
+        value = np.zeros(len(shares))
+        for column in columns:
+            if column in shares.columns:
+                value = value + shares[column].to_numpy()
+        stats[key] = _to_percent(value, ndigits)
+    return stats
+
+
+def _get_daily_df(path: Path, start: date, end: date) -> pd.DataFrame:
+    # downloads per day, python version, glibc version and policy
+    df = consumer_store.load(path, start, end)
+    df["policy"] = _get_policy(df["pip_version"], df["glibc_version"])
+    df.drop(columns=["pip_version"], inplace=True)
     df = df[(df["cpu"] == "x86_64") | (df["cpu"] == "i686")]
     df.drop(columns=["cpu"], inplace=True)
-    df = df.groupby(
-        ["day", "python_version", "glibc_version", "policy"], as_index=False
-    ).aggregate(np.sum)
+    return df.groupby(_KEYS, as_index=False).aggregate(np.sum)
 
-    # apply rolling window
+
+def _get_rolling_df(daily_df: pd.DataFrame, start: date) -> pd.DataFrame:
     df = pd.pivot_table(
-        df,
+        daily_df,
         index="day",
-        columns=["python_version", "glibc_version", "policy"],
+        columns=_KEYS[1:],
         values="num_downloads",
         fill_value=0,
         aggfunc="sum",
@@ -180,32 +127,156 @@ def update(path: Path, start: datetime, end: datetime):
     df = df.stack(list(range(df.columns.nlevels))).reset_index().fillna(0.0)
     df.rename(columns={0: "num_downloads"}, inplace=True)
     df = df[(df["num_downloads"] > 0) & (df["day"] >= pd.to_datetime(start))]
-    df = df.groupby(
-        ["day", "python_version", "glibc_version", "policy"], as_index=False
-    ).aggregate(np.sum)
-    df.set_index("day", append=True, inplace=True)
-    df = df.swaplevel()
-
-    # python version download stats
-    df_python = (
-        df[["python_version", "num_downloads"]]
-        .groupby(["day", "python_version"])
-        .aggregate(np.sum)
-    )
-    df_python_all = df_python.groupby(["day"]).aggregate(np.sum)
-    df_python_stats = df_python / df_python_all
-    # glibc version download stats
-    df_glibc = (
-        df[["glibc_version", "num_downloads"]]
-        .groupby(["day", "glibc_version"])
-        .aggregate(np.sum)
+    return df.groupby(_KEYS, as_index=False).aggregate(np.sum)
+
+
+def _get_fingerprint() -> str:
+    # any change invalidates the persisted state
+    return repr((_STATE_VERSION, utils.CONSUMER_WINDOW_SIZE.days, POLICY_TABLE))
+
+
+def _encode_df(name: str, df: pd.DataFrame) -> dict[str, np.ndarray]:
+    result = {
+        f"{name}_day": df["day"].to_numpy(dtype="datetime64[D]").astype(np.int64),
+        f"{name}_policy": df["policy"].to_numpy(dtype=np.int64),
+        f"{name}_num_downloads": df["num_downloads"].to_numpy(),
+    }
+    for column in ("python_version", "glibc_version"):
+        codes, uniques = pd.factorize(df[column])
+        result[f"{name}_{column}"] = codes
+        result[f"{name}_{column}_categories"] = np.asarray(uniques, dtype=str)
+    return result
+
+
+def _decode_df(name: str, data: dict[str, np.ndarray]) -> pd.DataFrame:
+    day = data[f"{name}_day"].astype("datetime64[D]").astype("datetime64[ns]")
+    df = pd.DataFrame({"day": day})
+    for column in ("python_version", "glibc_version"):
+        categories = data[f"{name}_{column}_categories"].astype(object)
+        df[column] = categories[data[f"{name}_{column}"]]
+    df["policy"] = data[f"{name}_policy"]
+    df["num_downloads"] = data[f"{name}_num_downloads"]
+    return df
+
+
+def _load_state() -> dict[str, Any] | None:
+    if not utils.CONSUMER_STATE_PATH.exists():
+        return None
+    with np.load(utils.CONSUMER_STATE_PATH, allow_pickle=False) as data:
+        if str(data["fingerprint"]) != _get_fingerprint():
+            _LOGGER.info("consumer state: outdated, discarding it")
+            return None
+        return {
+            "start": date.fromordinal(int(data["start"])),
+            "end": date.fromordinal(int(data["end"])),
+            "days": {date.fromordinal(day) for day in data["days"].tolist()},
+            "window": _decode_df("window", data),
+            "rolling": _decode_df("rolling", data),
+        }
+
+
+def _save_state(
+    start: date,
+    end: date,
+    days: set[date],
+    window_df: pd.DataFrame,
+    rolling_df: pd.DataFrame,
+) -> None:
+    with utils.atomic_write(utils.CONSUMER_STATE_PATH) as tmp_file:
+        np.savez(
+            tmp_file,
+            fingerprint=np.array(_get_fingerprint()),
+            start=np.int64(start.toordinal()),
+            end=np.int64(end.toordinal()),
+            days=np.array(sorted(day.toordinal() for day in days), dtype=np.int64),
+            **_encode_df("window", window_df),
+            **_encode_df("rolling", rolling_df),
+        )
+
+
+def _resume_rolling_df(
+    state: dict[str, Any], daily_df: pd.DataFrame, start: date, end: date
+) -> pd.DataFrame:
+    # Move the sliding window one day at a time from the end of the previous
+    # run: add the new day and remove the one leaving the window. Downloads
+    # are integers so this gives the same sums as a full recompute.
+    daily = {day: df.set_index(_KEYS[1:]) for day, df in daily_df.groupby("day")}
+    current = state["window"].groupby(_KEYS[1:])["num_downloads"].sum()
+    current = current.astype(np.float64)
+    dataframes = [state["rolling"][state["rolling"]["day"] >= pd.to_datetime(start)]]
+    day = pd.to_datetime(state["end"])
+    while day < pd.to_datetime(end):
+        for day_, sign in ((day, 1.0), (day - utils.CONSUMER_WINDOW_SIZE, -1.0)):
+            if day_ in daily:
+                current = current.add(
+                    sign * daily[day_]["num_downloads"], fill_value=0.0
+                )
+        current = current[current != 0.0]
+        if day in daily and day >= pd.to_datetime(start):
+            df = current[current > 0.0].reset_index()
+            df.insert(0, "day", day)
+            dataframes.append(df)
+        day += timedelta(days=1)
+    df = pd.concat(dataframes, ignore_index=True)
+    return df.sort_values(_KEYS, ignore_index=True)
+
+
+def _update_rolling_df(path: Path, start: date, end: date) -> pd.DataFrame:
+    # Only the last day is new in scheduled runs: reuse the previous run when
+    # the range only moved forward, the parameters didn't change and no data
+    # showed up late for the days it already processed.
+    history_start = start - utils.CONSUMER_WINDOW_SIZE
+    days = consumer_store.get_days(path, history_start, end)
+    state = _load_state()
+    if (
+        state is not None
+        and state["start"] <= start
+        and state["end"] <= end
+        and {day for day in days if day < state["end"]} <= state["days"]
+    ):
+        _LOGGER.info(f"consumer state: resuming from {state['end']}")
+        if any(day >= state["end"] for day in days):
+            daily_df = _get_daily_df(path, state["end"], end)
+        else:
+            daily_df = state["window"].iloc[:0]
+        rolling_df = _resume_rolling_df(
+            state, pd.concat([state["window"], daily_df]), start, end
+        )
+        window_df = pd.concat([state["window"], daily_df])
+    else:
+        _LOGGER.info("consumer state: full recompute")
+        window_df = _get_daily_df(path, history_start, end)
+        rolling_df = _get_rolling_df(window_df, start)
+    window_start = pd.to_datetime(end - utils.CONSUMER_WINDOW_SIZE)
+    window_df = window_df[window_df["day"] >= window_start]
+    _save_state(start, end, days, window_df, rolling_df)
+    return rolling_df
+
+
+def _get_output_fingerprint(path: Path, start: date, end: date) -> str:
+    # the daily files are hashed, their mtime changes with each checkout
+    digest = hashlib.sha256()
+    history_start = start - utils.CONSUMER_WINDOW_SIZE
+    for file in sorted(path.glob("*/*/*.csv")):
+        day = date(int(file.parent.parent.name), int(file.parent.name), int(file.stem))
+        if history_start <= day < end:
+            digest.update(day.isoformat().encode())
+            digest.update(file.read_bytes())
+    return artifacts.get_fingerprint(
+        _OUTPUT_VERSION, _get_fingerprint(), start, end, digest.hexdigest()
     )
-    df_glibc_all = df_glibc.groupby(["day"]).aggregate(np.sum)
-    df_glibc_stats = df_glibc / df_glibc_all
 
+
+def update(path: Path, start: date, end: date, output: Path):
+    fingerprint = _get_output_fingerprint(path, start, end)
+    if artifacts.restore(output, fingerprint):
+        return
+    df = _update_rolling_df(path, start, end)
+
+    index = pd.DatetimeIndex(df["day"].unique()).sort_values()
     out: dict[str, Any] = {
         "last_update": datetime.now(timezone.utc).strftime("%A, %d %B %Y, %H:%M:%S %Z"),
-        "index": list(d.date().isoformat() for d in df_python_all.index),
+        "index": list(d.date().isoformat() for d in index),
     }
 
     # combine some versions to remove some of the less used ones
@@ -225,98 +296,38 @@ def update(path: Path, start: datetime, end: datetime):
         ("2.35", "2.36"),
     ]
     glibc_versions = glibc_versions[::-1]
-    glibc_version = dict[str, Union[list[str], list[float]]]()
-    glibc_version["keys"] = list(v[0] for v in glibc_versions)
-    for versions in glibc_versions:
-        stats = []
-        for day in out["index"]:
-            value = 0.0
-            for version in versions:
-                try:
-                    value += float(
-                        df_glibc_stats.loc[
-                            (pd.to_datetime(day), version), "num_downloads"
-                        ]
-                    )
-                except KeyError:
-                    pass
-            stats.append(float(f"{100.0 * value:.2f}"))
-        glibc_version[versions[0]] = stats
-    out["glibc_version"] = glibc_version
+    out["glibc_version"] = _get_stats(
+        _get_shares(df, index, "glibc_version"),
+        {versions[0]: versions for versions in glibc_versions},
+        2,
+    )
 
     python_versions = ["2.7", "3.5", "3.6", "3.7", "3.8", "3.9", "3.10", "3.11", "3.12"]
-    python_version = dict[str, Union[list[str], list[float]]]()
+    python_version = _get_stats(
+        _get_shares(df, index, "python_version"),
+        {version: (version,) for version in python_versions},
+        1,
+    )
     policy_readiness = dict[str, dict[str, Union[list[str], list[float]]]]()
     glibc_readiness = dict[str, dict[str, Union[list[str], list[float]]]]()
-    python_version["keys"] = python_versions
     for version in python_versions:
-        stats = []
-        for day in out["index"]:
-            try:
-                value = float(
-                    df_python_stats.loc[(pd.to_datetime(day), version), "num_downloads"]
-                )
-            except KeyError:
-                value = 0.0
-            stats.append(float(f"{100.0 * value:.1f}"))
-        python_version[version] = stats
-
         df_python_version = df[df["python_version"] == version]
-
-        df_policy = (
-            df_python_version[["policy", "num_downloads"]]
-            .groupby(["day", "policy"])
-            .aggregate(np.sum)
-        )
-        df_policy_all = df_policy.groupby(["day"]).aggregate(np.sum)
-        df_policy_stats = df_policy / df_policy_all
-        policy_readiness_ver = dict[str, Union[list[str], list[float]]]()
-        policy_readiness_ver["keys"] = list(
-            POLICIES[i] for i in range(len(POLICIES))[::-1]
+        policy_readiness[version] = _get_stats(
+            _get_shares(df_python_version, index, "policy"),
+            {POLICIES[i]: (i,) for i in range(len(POLICIES))[::-1]},
+            2,
         )
-        policy_readiness[version] = policy_readiness_ver
-        for i in range(len(POLICIES))[::-1]:
-            policy = POLICIES[i]
-            stats = []
-            for day in out["index"]:
-                try:
-                    value = float(
-                        df_policy_stats.loc[(pd.to_datetime(day), i), "num_downloads"]
-                    )
-                except KeyError:
-                    value = 0.0
-                stats.append(float(f"{100.0 * value:.2f}"))
-            policy_readiness_ver[policy] = stats
-
-        df_glibc = (
-            df_python_version[["glibc_version", "num_downloads"]]
-            .groupby(["day", "glibc_version"])
-            .aggregate(np.sum)
+        glibc_readiness[version] = _get_stats(
+            _get_shares(df_python_version, index, "glibc_version"),
+            {versions[0]: versions for versions in glibc_versions},
+            2,
         )
-        df_glibc_all = df_glibc.groupby(["day"]).aggregate(np.sum)
-        df_glibc_stats = df_glibc / df_policy_all
-        glibc_readiness_ver = dict[str, Union[list[str], list[float]]]()
-        glibc_readiness_ver["keys"] = list(v[0] for v in glibc_versions)
-        glibc_readiness[version] = glibc_readiness_ver
-        for versions in glibc_versions:
-            stats = []
-            for day in out["index"]:
-                value = 0.0
-                for glibc_version in versions:
-                    try:
-                        value += float(
-                            df_glibc_stats.loc[
-                                (pd.to_datetime(day), glibc_version), "num_downloads"
-                            ]
-                        )
-                    except KeyError:
-                        pass
-                stats.append(float(f"{100.0 * value:.2f}"))
-            glibc_readiness_ver[versions[0]] = stats
 
     out["python_version"] = python_version
     out["policy_readiness"] = policy_readiness
     out["glibc_readiness"] = glibc_readiness
 
-    with open(utils.CONSUMER_DATA_PATH, "w") as f:
-        json.dump(out, f, separators=(",", ":"))
+    with utils.atomic_write(output) as tmp_file:
+        with open(tmp_file, "w") as f:
+            json.dump(out, f, separators=(",", ":"))
+    artifacts.store(output, fingerprint)
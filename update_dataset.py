@@ -1,98 +1,214 @@
+import itertools
 import json
 import logging
+import multiprocessing
+from collections.abc import Iterable, Iterator
 from datetime import date
+from typing import Any
 
-from packaging.version import InvalidVersion, Version
-
+import metrics
+import release_cache
 import utils
 
 _LOGGER = logging.getLogger(__name__)
+# bump when the parsing of release info changes
+_STORE_VERSION = 2
+# packages sent at once to a worker process
+_CHUNK_SIZE = 64
 
 
-def _filter_versions(package: str, info: dict) -> list[str]:
-    candidate_versions = []
-    for version in info["releases"].keys():
-        try:
-            version_pep = Version(version)
-            candidate_versions.append((version, version_pep))
-        except InvalidVersion as e:
-            _LOGGER.warning(f'"{package}": {e}')
-
-    candidate_versions.sort(key=lambda x: x[1], reverse=True)
+def _filter_releases(releases: list[list[str]]) -> list[list[str]]:
+    # releases are sorted from the newest version to the oldest one
     filtered = []
     upload_date_previous_date = date.max.isoformat()
-    for version, _ in candidate_versions:
-        upload_date = date.max.isoformat()
-        for file in info["releases"][version]:
-            upload_date = min(upload_date, file["upload_time"])
+    for release in releases:
+        upload_date = release[1]
         # Keep at most one version per day and do not keep maintenance branch
         # i.e dates shall be in same order as versions
         if upload_date < upload_date_previous_date:
             upload_date_previous_date = upload_date
-            filtered.append(version)
+            filtered.append(release)
     return filtered
 
 
-def _parse_version(files: list[dict[str, str]]) -> tuple[date, str, str]:
-    upload_date = date.max.isoformat()
-    pythons = set()
-    manylinux = set()
-    for file in files:
-        upload_date = min(upload_date, file["upload_time"])
-        filename = file["filename"]
-        if not filename.lower().endswith(".whl"):
-            continue
-        parsed_filename = utils.WHEEL_INFO_RE.match(filename)
-        if parsed_filename is None:
-            continue
-        metadata = utils.WheelMetadata(*parsed_filename.groups()[1:])
-        for python in metadata.implementation.replace(",", ".").split("."):
-            try:
-                int(python[2:])
-            except ValueError:
-                _LOGGER.warning(f'ignoring python "{python}" for wheel "{filename}"')
-                continue
-            pythons.add(python)
-            if metadata.abi == "abi3":
-                if not python.startswith("cp3"):
-                    _LOGGER.warning(
-                        f'ignoring python "{python}-abi3" for wheel "{filename}"'
-                    )
-                    continue
-                # Add abi3 to know that cp3? > {python} are supported
-                pythons.add("ab3")
-        manylinux.add(metadata.platform)
-    python_list = list(pythons)
-    python_list.sort(key=lambda x: (int(x[2:]), x[0:2]))
-    python_str = ".".join(python_list).replace("ab3", "abi3")
-    manylinux_str = ".".join(sorted(manylinux)).replace("anylinux", "l")
-    return date.fromisoformat(upload_date), python_str, manylinux_str
-
-
-def _package_update(package: str) -> list[utils.Row]:
-    cache_file = utils.get_release_cache_path(package)
-    if not cache_file.exists():
-        return []
-    with open(cache_file) as f:
-        info = json.load(f)
-
-    versions = _filter_versions(package, info)
+def _get_policies(manylinux: str) -> int:
+    result = 0
+    for i, policy in enumerate(utils.POLICIES):
+        if f"{policy}_x86_64" in manylinux:
+            result |= 1 << i
+    return result
+
+
+def _get_architectures(manylinux: str) -> int:
+    result = 0
+    for i, arch in enumerate(utils.ARCHITECTURES):
+        if arch in manylinux:
+            result |= 1 << i
+    return result
+
+
+def _get_implementations(python: str) -> int:
+    supported = {
+        version: version in python
+        for version in itertools.chain(
+            utils.IMPL_X2, utils.IMPL_PP3, ["py2", "py3", "abi3", "cp32"]
+        )
+    }
+    for i in range(3, utils.IMPL_CP3_LAST + 1):
+        version = f"cp3{i}"
+        version_prev = f"cp3{i - 1}"
+        supported[version] = version in python or (
+            supported["abi3"] and supported[version_prev]
+        )
+    supported["any2"] = "py2" in python or "cp2" in python or "pp2" in python
+    supported["any3"] = "py3" in python or "cp3" in python or "pp3" in python
+    result = 0
+    for i, implementation in enumerate(utils.IMPLEMENTATIONS):
+        if supported[implementation]:
+            result |= 1 << i
+    return result
+
+
+def _get_fingerprint() -> str:
+    # rows are only valid as long as the flags they encode keep their meaning
+    return repr(
+        (
+            _STORE_VERSION,
+            utils.POLICIES,
+            utils.ARCHITECTURES,
+            utils.IMPLEMENTATIONS,
+        )
+    )
+
+
+def _load_store() -> dict[str, dict[str, Any]]:
+    if not utils.DATASET_STORE_PATH.exists():
+        return {}
+    with open(utils.DATASET_STORE_PATH) as f:
+        store = json.load(f)
+    if store["fingerprint"] != _get_fingerprint():
+        _LOGGER.info("dataset store is outdated, reparsing all packages")
+        return {}
+    return store["packages"]
+
+
+def _save_store(packages: dict[str, dict[str, Any]]) -> None:
+    with utils.atomic_write(utils.DATASET_STORE_PATH) as tmp_file:
+        with open(tmp_file, "w") as f:
+            json.dump({"fingerprint": _get_fingerprint(), "packages": packages}, f)
+
+
+def _encode_rows(rows: list[utils.Row]) -> list[list[Any]]:
+    return [[row.day.isoformat(), *row[2:]] for row in rows]
+
+
+def _decode_rows(package: str, rows: list[list[Any]]) -> list[utils.Row]:
+    return [
+        utils.Row(date.fromisoformat(day), package, *values) for day, *values in rows
+    ]
+
+
+def _parse_info(package: str, info: dict) -> list[utils.Row]:
+    releases = _filter_releases(info["releases"])
+    versions = [release[0] for release in releases]
     _LOGGER.debug(f'"{package}": using "{versions}"')
     rows = []
-    for version in versions:
-        week, python, manylinux = _parse_version(info["releases"][version])
+    for version, upload_date, python, manylinux in releases:
         if python == "" or manylinux == "":
             continue
-        rows.append(utils.Row(week, package, version, python, manylinux))
+        rows.append(
+            utils.Row(
+                date.fromisoformat(upload_date),
+                package,
+                version,
+                python,
+                manylinux,
+                _get_policies(manylinux),
+                _get_architectures(manylinux),
+                _get_implementations(python),
+            )
+        )
     if len(versions) and not len(rows):
         _LOGGER.warning(f'"{package}": no manylinux wheel in "{versions}"')
     return rows
 
 
-def update(packages: list[str]) -> tuple[list[str], list[utils.Row]]:
+def _package_update(
+    item: tuple[str, str, str, dict[str, Any] | None]
+) -> tuple[str, list[utils.Row], dict[str, Any]]:
+    package, stamp, raw_info, entry = item
+    _LOGGER.info(f'"{package}": begin dataset creation')
+    info = json.loads(raw_info)
+    if entry is not None and entry["etag"] == info["etag"]:
+        rows = _decode_rows(package, entry["rows"])
+    else:
+        _LOGGER.debug(f'"{package}": parsing release info')
+        rows = _parse_info(package, info)
+    entry = {"etag": info["etag"], "stamp": stamp, "rows": _encode_rows(rows)}
+    _LOGGER.debug(f'"{package}": end dataset creation')
+    return package, rows, entry
+
+
+def _init_worker(level: int) -> None:
+    # spawned workers don't inherit the logging configuration of update.py
+    logging.basicConfig(level=level)
+
+
+def _package_update_all(
+    items: Iterable[tuple[str, str, str, dict[str, Any] | None]],
+    count: int,
+    jobs: int,
+) -> Iterator[tuple[str, list[utils.Row], dict[str, Any]]]:
+    if jobs <= 1 or count <= _CHUNK_SIZE:
+        yield from map(_package_update, items)
+        return
+    # imap keeps the input order which keeps the dataset deterministic,
+    # chunks amortize the cost of sending rows back to this process.
+    # items are read by batches in this thread, the release cache might not
+    # support being read from the thread feeding the pool.
+    # The pool is started while other stages run in threads, forking such a
+    # process is unsafe: workers are spawned instead.
+    items = iter(items)
+    level = logging.getLogger().getEffectiveLevel()
+    with multiprocessing.get_context("spawn").Pool(
+        jobs, _init_worker, (level,)
+    ) as pool:
+        while batch := list(itertools.islice(items, _CHUNK_SIZE * jobs * 4)):
+            yield from pool.imap(_package_update, batch, _CHUNK_SIZE)
+
+
+def update(
+    packages: list[str], cache: release_cache.ReleaseCache, jobs: int = 1
+) -> tuple[list[str], list[utils.Row]]:
+    store = _load_store()
+    new_store = {}
+    stamps = cache.get_stamps(packages)
+    results: dict[str, list[utils.Row]] = {}
+    to_parse = []
+    for package in packages:
+        entry = store.get(package)
+        if package not in stamps:
+            continue  # not in cache
+        # the release cache tells us when the info of a package changed so
+        # that the stored rows can be used without reading the info again
+        if entry is not None and entry["stamp"] == stamps[package]:
+            results[package] = _decode_rows(package, entry["rows"])
+            new_store[package] = entry
+        else:
+            to_parse.append(package)
+    _LOGGER.info(f"parsing release info of {len(to_parse)} packages")
+    metrics.count("packages_parsed", len(to_parse))
+    metrics.count("packages_reused", len(results))
+    items = (
+        (package, stamps[package], raw_info, store.get(package))
+        for package, raw_info in cache.iter_raw(to_parse)
+    )
+    for package, package_rows, entry in _package_update_all(items, len(to_parse), jobs):
+        results[package] = package_rows
+        new_store[package] = entry
     rows = []
     for package in packages:
-        _LOGGER.info(f'"{package}": begin dataset creation')
-        rows.extend(_package_update(package))
-        _LOGGER.debug(f'"{package}": end dataset creation')
+        rows.extend(results.get(package, []))
+    _save_store(new_store)
+    metrics.count("rows", len(rows))
     return list(sorted({r.package for r in rows})), rows
@@ -5,16 +5,21 @@ import os
 import sqlite3
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from tempfile import NamedTemporaryFile, TemporaryDirectory
+from shutil import copyfileobj
+from tempfile import TemporaryDirectory
 
-import lastversion
-import requests
-from google.api_core.exceptions import Forbidden, GoogleAPIError
-from google.cloud import bigquery
 from packaging.utils import canonicalize_name
 
+import metrics
+import negative_cache
+import utils
+
 _LOGGER = logging.getLogger(__name__)
 BIGQUERY_TOKEN = "BIGQUERY_TOKEN"
+_PYPI_DATA_DB_PATH = utils.PYPI_DATA_PATH / "pypi.db"
+# asset URL & ETag of the database in _PYPI_DATA_DB_PATH
+_PYPI_DATA_STATE_PATH = utils.PYPI_DATA_PATH / "state.json"
+_CHUNK_SIZE = 1024 * 1024
 
 
 class _Item:
@@ -40,6 +45,10 @@ def _merge(source: str, new_packages: set[str], packages_set: set[str]):
 
 
 def _update_bigquery(bigquery_credentials: Path | None, packages_set: set[str]) -> None:
+    # sources are imported when used, most runs don't use any of them
+    from google.api_core.exceptions import Forbidden, GoogleAPIError
+    from google.cloud import bigquery
+
     _LOGGER.info("bigquery: fetching packages")
     today = datetime.fromisocalendar(*datetime.now(timezone.utc).isocalendar())
     table_suffix = (today - timedelta(days=1)).strftime("%Y-%m-%d")
@@ -85,6 +94,8 @@ def _update_bigquery(bigquery_credentials: Path | None, packages_set: set[str])
 
 
 def _update_top_packages(packages_set: set[str]) -> None:
+    import requests
+
     _LOGGER.info("top pypi: fetching packages")
     response = requests.get(
         "https://hugovk.github.io/top-pypi-packages/"
@@ -96,7 +107,52 @@ def _update_top_packages(packages_set: set[str]) -> None:
     _merge("top pypi", top_packages, packages_set)
 
 
+def _load_pypi_data_state() -> dict[str, str] | None:
+    if not _PYPI_DATA_STATE_PATH.exists() or not _PYPI_DATA_DB_PATH.exists():
+        return None
+    with open(_PYPI_DATA_STATE_PATH) as f:
+        return dict(json.load(f))
+
+
+def _download_pypi_data(db_url: str) -> None:
+    # The database is several GB once decompressed, it's decompressed while
+    # it's downloaded rather than in memory and kept until a new release is
+    # published, or the asset changes.
+    import requests
+
+    headers = {"User-Agent": utils.USER_AGENT}
+    state = _load_pypi_data_state()
+    if state is not None and state["url"] == db_url:
+        if not state["etag"]:
+            # the URL of the asset already changes with each release
+            _LOGGER.debug("pypi data: using cached database")
+            return
+        headers["If-None-Match"] = state["etag"]
+    _LOGGER.debug("pypi data: download database")
+    response = requests.get(db_url, headers=headers, stream=True, timeout=60.0)
+    try:
+        response.raise_for_status()
+        if response.status_code == 304:
+            _LOGGER.debug("pypi data: using cached database")
+            return
+        utils.PYPI_DATA_PATH.mkdir(parents=True, exist_ok=True)
+        response.raw.decode_content = True
+        with utils.atomic_write(_PYPI_DATA_DB_PATH) as tmp_file:
+            with gzip.GzipFile(fileobj=response.raw) as db, open(tmp_file, "wb") as f:
+                copyfileobj(db, f, _CHUNK_SIZE)
+            metrics.count("bytes_downloaded", response.raw.tell())
+            # the state is only valid for the database it was written with
+            _PYPI_DATA_STATE_PATH.unlink(missing_ok=True)
+        with utils.atomic_write(_PYPI_DATA_STATE_PATH) as tmp_file:
+            with open(tmp_file, "w") as f:
+                json.dump({"url": db_url, "etag": response.headers.get("etag", "")}, f)
+    finally:
+        response.close()
+
+
 def _update_pypi_data(packages_set: set[str]) -> None:
+    import lastversion
+
     _LOGGER.info("pypi data: fetching packages")
     query = (
         'SELECT package_name FROM wheels WHERE platform LIKE "%manylinux%" '
@@ -107,22 +163,17 @@ def _update_pypi_data(packages_set: set[str]) -> None:
         output_format="assets",
         having_asset="pypi.db.gz",
     )[0]
-    _LOGGER.debug("pypi data: download database")
-    response = requests.get(db_url)
-    response.raise_for_status()
-    with NamedTemporaryFile() as f:
-        _LOGGER.debug("pypi data: decompress database")
-        f.write(gzip.decompress(response.content))
-        _LOGGER.debug("pypi data: execute database query")
-        con = sqlite3.connect(f.name)
+    _download_pypi_data(db_url)
+    _LOGGER.debug("pypi data: execute database query")
+    con = sqlite3.connect(f"file:{_PYPI_DATA_DB_PATH}?mode=ro", uri=True)
+    try:
+        cur = con.execute(query)
         try:
-            cur = con.execute(query)
-            try:
-                new_packages = {row[0] for row in cur.fetchall()}
-            finally:
-                cur.close()
+            new_packages = {row[0] for row in cur.fetchall()}
         finally:
-            con.close()
+            cur.close()
+    finally:
+        con.close()
     _merge("pypi data", new_packages, packages_set)
 
 
@@ -131,6 +182,7 @@ def update(
     use_top_packages: bool,
     use_sethmlarson_pypi_data: bool,
     bigquery_credentials: Path | None,
+    negative: negative_cache.NegativeCache,
 ) -> list[str]:
     packages_set = set(packages)
     if use_top_packages:
@@ -139,4 +191,12 @@ def update(
         _update_pypi_data(packages_set)
     if bigquery_credentials or os.environ.get(BIGQUERY_TOKEN, "") != "":
         _update_bigquery(bigquery_credentials, packages_set)
+    # do not bring back packages that were dropped recently for a good reason
+    excluded = {
+        package for package in packages_set - set(packages) if package in negative
+    }
+    if excluded:
+        _LOGGER.debug(f"ignoring {len(excluded)} packages from the negative cache")
+        packages_set -= excluded
+    metrics.count("packages_added", len(packages_set - set(packages)))
     return list(sorted(packages_set))
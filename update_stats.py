@@ -1,74 +1,20 @@
-import itertools
+import hashlib
 import json
 import logging
-from collections.abc import Iterable
 from datetime import datetime, timedelta, timezone
 
 import numpy as np
 import pandas as pd
 
+import artifacts
 import utils
 
 _LOGGER = logging.getLogger(__name__)
-
-POLICIES = (
-    "ml1",
-    "ml2010",
-    "ml2014",
-    "ml_2_24",
-    "ml_2_27",
-    "ml_2_28",
-    "ml_2_31",
-    "ml_2_34",
-    "ml_2_35",
-)
-ARCHITECTURES = ("x86_64", "i686", "aarch64", "ppc64le", "s390x", "armv7l")
-# python implementations are a bit more complicated...
-IMPL_X2 = ("cp27",)
-IMPL_CP3_FIRST = 5
-IMPL_CP3_LAST = 12
-IMPL_PP3 = tuple(f"pp3{i}" for i in range(7, 9 + 1))
-# that's what is ultimately displayed
-IMPLEMENTATIONS = tuple(
-    itertools.chain(
-        ["any2", "py2"],
-        IMPL_X2,
-        ["any3", "py3"],
-        sorted(
-            itertools.chain(
-                IMPL_PP3, [f"cp3{i}" for i in range(IMPL_CP3_FIRST, IMPL_CP3_LAST + 1)]
-            ),
-            key=lambda x: (int(x[3:]), x[:3]),
-        ),
-        ["abi3"],
-    )
-)
+# bump when the output changes for the same inputs
+_OUTPUT_VERSION = 1
 
 
 def _get_range_dataframe(df: pd.DataFrame, start, end) -> pd.DataFrame:
-    for policy in POLICIES:
-        df[policy] = df.manylinux.str.contains(f"{policy}_x86_64")
-    for arch in ARCHITECTURES:
-        df[arch] = df.manylinux.str.contains(arch)
-    for version in itertools.chain(IMPL_X2, IMPL_PP3, ["py2", "py3", "abi3"]):
-        df[version] = df.python.str.contains(version)
-    df["cp32"] = df.python.str.contains("cp32")
-    for i in range(3, IMPL_CP3_LAST + 1):
-        version = f"cp3{i}"
-        version_prev = f"cp3{i - 1}"
-        df[version] = df.python.str.contains(version) | (
-            df["abi3"] & df[f"{version_prev}"]
-        )
-    df["any2"] = (
-        df.python.str.contains("py2")
-        | df.python.str.contains("cp2")
-        | df.python.str.contains("pp2")
-    )
-    df["any3"] = (
-        df.python.str.contains("py3")
-        | df.python.str.contains("cp3")
-        | df.python.str.contains("pp3")
-    )
     df_r = df[(df["day"] >= (start - utils.PRODUCER_WINDOW_SIZE)) & (df["day"] < end)]
     df_r = df_r.drop(columns=["version", "python", "manylinux"])
     return df_r.sort_values("day", ascending=False).copy(deep=True)
@@ -77,36 +23,67 @@ def _get_range_dataframe(df: pd.DataFrame, start, end) -> pd.DataFrame:
 def _get_rolling_dataframe(
     df: pd.DataFrame, start_date, end_date
 ) -> tuple[list[str], pd.DataFrame]:
-    current = end_date
+    # Each row is the latest release of its package in the sliding window for
+    # every day in (day, min(day + window size, day of next release)].
+    # Rather than building one frame per day, keep the range of days, as
+    # [enter, leave) indices from start_date, during which each row is in the
+    # window. Per-day counts are then only updated when a row enters/leaves it.
     step = timedelta(days=1)
-    index = []
-    rolling_dfs = []
-    while current >= start_date:
-        window_start = current - utils.PRODUCER_WINDOW_SIZE
-        df_window = (
-            df[(df["day"] >= window_start) & (df["day"] < current)]
-            .drop_duplicates(["package"])
-            .drop(columns=["package"])
-        )
-        df_window["day"] = current
-        rolling_dfs.append(df_window)
-        index.append(current)
-        current -= step
-    index_as_str = list(d.date().isoformat() for d in index[::-1])
-    return index_as_str, pd.concat(rolling_dfs).sort_values("day")
-
-
-def _get_stats_df(full_dataframe: pd.DataFrame, columns: Iterable[str]) -> pd.DataFrame:
-    columns_ = list(columns)
-    values = full_dataframe.value_counts(subset=["day"] + columns_, sort=False)
-    df_with_count = values.unstack(columns_, fill_value=0.0)
-    return df_with_count.apply(lambda x: x / np.sum(x), axis=1)
+    day_count = (end_date - start_date).days + 1
+    df = df.sort_values(["package", "day"], kind="stable").drop_duplicates(
+        ["package", "day"]
+    )
+    next_day = df.groupby("package")["day"].shift(-1)
+    last_day = df["day"] + utils.PRODUCER_WINDOW_SIZE
+    last_day = last_day.where(next_day.isna() | (last_day < next_day), next_day)
+    enter = ((df["day"] + step - start_date) // step).clip(lower=0)
+    leave = ((last_day + step - start_date) // step).clip(upper=day_count)
+    rolling_df = df.drop(columns=["day", "package"])
+    rolling_df["enter"] = enter
+    rolling_df["leave"] = leave
+    rolling_df = rolling_df[enter < leave]
+    index = pd.date_range(start_date, end_date, freq=step)
+    index_as_str = list(d.date().isoformat() for d in index)
+    return index_as_str, rolling_df
+
+
+def _get_counts(
+    rolling_df: pd.DataFrame, values: np.ndarray, day_count: int
+) -> tuple[np.ndarray, np.ndarray]:
+    # number of rows in the window for each day and each value
+    uniques, unique_index = np.unique(values, return_inverse=True)
+    size = (day_count + 1) * len(uniques)
+    enter = rolling_df["enter"].to_numpy() * len(uniques) + unique_index
+    leave = rolling_df["leave"].to_numpy() * len(uniques) + unique_index
+    events = np.bincount(enter, minlength=size) - np.bincount(leave, minlength=size)
+    events = events.reshape(day_count + 1, len(uniques))
+    return uniques, events.cumsum(axis=0)[:day_count]
+
+
+def _get_stats_df(
+    rolling_df: pd.DataFrame, column: str, size: int, day_count: int
+) -> tuple[np.ndarray, np.ndarray]:
+    # share of packages using each flags combination for days with packages
+    combinations, counts = _get_counts(
+        rolling_df, rolling_df[column].to_numpy(), day_count
+    )
+    counts = counts[counts.sum(axis=1) > 0]
+    # Shares are summed in a fixed order to keep the rounding stable: order
+    # combinations by the first day they're used then as if each bit was its
+    # own boolean column, the first bit being the most significant one.
+    key = np.zeros_like(combinations)
+    for i in range(size):
+        key |= ((combinations >> i) & 1) << (size - 1 - i)
+    first_day = np.argmax(counts > 0, axis=0)
+    order = np.lexsort((key, first_day))
+    counts = counts[:, order]
+    return combinations[order], counts / counts.sum(axis=1, keepdims=True)
 
 
-def _get_stats(df: pd.DataFrame, key, level: Iterable[str]) -> list[float]:
-    ts = df.xs(key=tuple(key), axis=1, level=level).apply(np.sum, axis=1)
-    ts.index = pd.DatetimeIndex(ts.index.get_level_values(0).values, name="day")
-    return list(float(f"{100.0 * value:.1f}") for value in ts.sort_index().values)
+def _get_stats(shares: np.ndarray, selected: np.ndarray) -> list[float]:
+    # rows must be contiguous for numpy to use pairwise summation
+    values = np.sum(np.ascontiguousarray(shares[:, selected]), axis=1)
+    return list(float(f"{100.0 * value:.1f}") for value in values)
 
 
 def _get_total_packages(df: pd.DataFrame, start_date, end_date) -> list[int]:
@@ -125,7 +102,26 @@ def _get_total_packages(df: pd.DataFrame, start_date, end_date) -> list[int]:
     return ts.sort_index().values.tolist()
 
 
-def update(rows, start, end):
+def _get_output_fingerprint(rows, start, end) -> str:
+    digest = hashlib.sha256()
+    for row in rows:
+        digest.update(repr(row).encode())
+    return artifacts.get_fingerprint(
+        _OUTPUT_VERSION,
+        utils.PRODUCER_WINDOW_SIZE.days,
+        utils.POLICIES,
+        utils.ARCHITECTURES,
+        utils.IMPLEMENTATIONS,
+        start,
+        end,
+        digest.hexdigest(),
+    )
+
+
+def update(rows, start, end, output):
+    fingerprint = _get_output_fingerprint(rows, start, end)
+    if artifacts.restore(output, fingerprint):
+        return
     out = {
         "last_update": datetime.now(timezone.utc).strftime("%A, %d %B %Y, %H:%M:%S %Z"),
         "package_count": 0,
@@ -154,35 +150,48 @@ def update(rows, start, end):
     out["index"], rolling_df = _get_rolling_dataframe(df, start_date, end_date)
 
     _LOGGER.info("compute statistics")
-    ts = rolling_df.value_counts(subset=["day"], sort=False)
-    ts.index = pd.DatetimeIndex(ts.index.get_level_values(0).values, name="day")
-    out["package"]["analysis"] = ts.sort_index().values.tolist()
-    policy_df = _get_stats_df(rolling_df[rolling_df["x86_64"]], POLICIES)
-    len_ = len(POLICIES)
+    day_count = len(out["index"])
+    _, counts = _get_counts(rolling_df, np.zeros(len(rolling_df)), day_count)
+    out["package"]["analysis"] = counts[counts[:, 0] > 0, 0].tolist()
+    x86_64 = 1 << utils.ARCHITECTURES.index("x86_64")
+    policies, policy_shares = _get_stats_df(
+        rolling_df[(rolling_df["architectures"] & x86_64) != 0],
+        "policies",
+        len(utils.POLICIES),
+        day_count,
+    )
     out["highest_policy"]["keys"] = []
     out["lowest_policy"]["keys"] = []
-    for i in range(len_):
-        name = POLICIES[i].replace("ml", "manylinux")
+    for i, policy in enumerate(utils.POLICIES):
+        name = policy.replace("ml", "manylinux")
         out["highest_policy"]["keys"].append(name)
-        out["highest_policy"][name] = _get_stats(
-            policy_df, key=[True] + [False] * (len_ - i - 1), level=POLICIES[i:]
-        )
+        out["highest_policy"][name] = _get_stats(policy_shares, (policies >> i) == 1)
         out["lowest_policy"]["keys"].append(name)
         out["lowest_policy"][name] = _get_stats(
-            policy_df, key=[False] * i + [True], level=POLICIES[: i + 1]
+            policy_shares, (policies & ((2 << i) - 1)) == (1 << i)
         )
 
-    arch_df = _get_stats_df(rolling_df, ARCHITECTURES)
+    architectures, arch_shares = _get_stats_df(
+        rolling_df, "architectures", len(utils.ARCHITECTURES), day_count
+    )
     out["architecture"]["keys"] = []
-    for arch in ARCHITECTURES:
+    for i, arch in enumerate(utils.ARCHITECTURES):
         out["architecture"]["keys"].append(arch)
-        out["architecture"][arch] = _get_stats(arch_df, key=[True], level=[arch])
+        out["architecture"][arch] = _get_stats(
+            arch_shares, (architectures & (1 << i)) != 0
+        )
 
-    impl_df = _get_stats_df(rolling_df, IMPLEMENTATIONS)
+    implementations, impl_shares = _get_stats_df(
+        rolling_df, "implementations", len(utils.IMPLEMENTATIONS), day_count
+    )
     out["implementation"]["keys"] = []
-    for impl in IMPLEMENTATIONS:
+    for i, impl in enumerate(utils.IMPLEMENTATIONS):
         out["implementation"]["keys"].append(impl)
-        out["implementation"][impl] = _get_stats(impl_df, key=[True], level=[impl])
+        out["implementation"][impl] = _get_stats(
+            impl_shares, (implementations & (1 << i)) != 0
+        )
 
-    with open(utils.PRODUCER_DATA_PATH, "w") as f:
-        json.dump(out, f, separators=(",", ":"))
+    with utils.atomic_write(output) as tmp_file:
+        with open(tmp_file, "w") as f:
+            json.dump(out, f, separators=(",", ":"))
+    artifacts.store(output, fingerprint)
@@ -1,4 +1,9 @@
+import contextlib
+import functools
+import itertools
 import re
+import sys
+from collections.abc import Iterator
 from datetime import date, timedelta
 from pathlib import Path
 from typing import NamedTuple
@@ -7,12 +12,58 @@ ROOT_PATH = Path(__file__).resolve().parent
 BUILD_PATH = ROOT_PATH / "build"
 PRODUCER_DATA_PATH = BUILD_PATH / "producer-data.json"
 CONSUMER_DATA_PATH = BUILD_PATH / "consumer-data.json"
+METRICS_PATH = BUILD_PATH / "metrics.json"
 CACHE_PATH = ROOT_PATH / "cache"
 RELEASE_INFO_PATH = CACHE_PATH / "info"
+RELEASE_DB_PATH = CACHE_PATH / "info.sqlite"
+CHANGELOG_STATE_PATH = CACHE_PATH / "changelog.json"
+NEGATIVE_CACHE_PATH = CACHE_PATH / "negative.json"
+DATASET_STORE_PATH = CACHE_PATH / "dataset.json"
+CONSUMER_STORE_PATH = CACHE_PATH / "consumer"
+CONSUMER_STATE_PATH = CACHE_PATH / "consumer-state.npz"
+ARTIFACTS_PATH = CACHE_PATH / "artifacts"
+SHARDS_PATH = CACHE_PATH / "shards"
+# several GB, kept out of CACHE_PATH which CI saves on every run
+PYPI_DATA_PATH = ROOT_PATH / "pypi-data"
 PRODUCER_WINDOW_SIZE = timedelta(days=182)
 CONSUMER_WINDOW_SIZE = timedelta(days=28)
+# root of the PyPI JSON API, can be replaced by a stand-in server
+PYPI_URL = "https://pypi.org/pypi"
 USER_AGENT = "manylinux-timeline/1.0 " "(https://github.com/mayeut/manylinux-timeline)"
 
+POLICIES = (
+    "ml1",
+    "ml2010",
+    "ml2014",
+    "ml_2_24",
+    "ml_2_27",
+    "ml_2_28",
+    "ml_2_31",
+    "ml_2_34",
+    "ml_2_35",
+)
+ARCHITECTURES = ("x86_64", "i686", "aarch64", "ppc64le", "s390x", "armv7l")
+# python implementations are a bit more complicated...
+IMPL_X2 = ("cp27",)
+IMPL_CP3_FIRST = 5
+IMPL_CP3_LAST = 12
+IMPL_PP3 = tuple(f"pp3{i}" for i in range(7, 9 + 1))
+# that's what is ultimately displayed
+IMPLEMENTATIONS = tuple(
+    itertools.chain(
+        ["any2", "py2"],
+        IMPL_X2,
+        ["any3", "py3"],
+        sorted(
+            itertools.chain(
+                IMPL_PP3, [f"cp3{i}" for i in range(IMPL_CP3_FIRST, IMPL_CP3_LAST + 1)]
+            ),
+            key=lambda x: (int(x[3:]), x[:3]),
+        ),
+        ["abi3"],
+    )
+)
+
 
 class Row(NamedTuple):
     day: date
@@ -20,6 +71,11 @@ class Row(NamedTuple):
     version: str
     python: str
     manylinux: str
+    # bit i is set when the release supports the i-th entry of
+    # POLICIES (x86_64 only), ARCHITECTURES and IMPLEMENTATIONS respectively
+    policies: int
+    architectures: int
+    implementations: int
 
 
 WHEEL_INFO_RE = re.compile(
@@ -38,5 +94,66 @@ class WheelMetadata(NamedTuple):
     platform: str
 
 
+def _is_fast_path_filename(filename: str) -> bool:
+    # names for which splitting on "-" gives the same result as WHEEL_INFO_RE
+    return filename.endswith(".whl") and filename.isascii() and "\n" not in filename
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def parse_wheel_filename(filename: str) -> WheelMetadata | None:
+    parts = filename[:-4].split("-") if _is_fast_path_filename(filename) else []
+    if len(parts) == 5 and all(parts):
+        name, version, implementation, abi, platform = parts
+        build_tag = None
+    elif len(parts) == 6 and all(parts) and parts[2][0] in "0123456789":
+        name, version, build_tag, implementation, abi, platform = parts
+    else:
+        match = WHEEL_INFO_RE.match(filename)
+        if match is None:
+            return None
+        name, version, build_tag, implementation, abi, platform = match.groups()[1:]
+    # tags are shared by a lot of wheels
+    return WheelMetadata(
+        name,
+        version,
+        build_tag,
+        sys.intern(implementation),
+        sys.intern(abi),
+        sys.intern(platform),
+    )
+
+
+def _python_tag_key(python: str) -> tuple[int, str]:
+    return int(python[2:]), python[0:2]
+
+
+@functools.lru_cache(maxsize=1 << 10)
+def split_python_tags(implementation: str) -> tuple[tuple[str, ...], tuple[str, ...]]:
+    # returns the valid python tags sorted by version and the invalid ones
+    valid = []
+    invalid = []
+    for python in implementation.replace(",", ".").split("."):
+        try:
+            int(python[2:])
+        except ValueError:
+            invalid.append(sys.intern(python))
+            continue
+        valid.append(sys.intern(python))
+    return tuple(sorted(valid, key=_python_tag_key)), tuple(invalid)
+
+
 def get_release_cache_path(package: str) -> Path:
     return RELEASE_INFO_PATH / f"{package}.json"
+
+
+@contextlib.contextmanager
+def atomic_write(path: Path) -> Iterator[Path]:
+    # yields a temporary file to write instead of path, it replaces path once
+    # written so that readers never see a partial file. The suffix is kept,
+    # np.savez would add its own otherwise.
+    tmp_file = path.with_name(f"{path.stem}.tmp{path.suffix}")
+    try:
+        yield tmp_file
+        tmp_file.replace(path)
+    finally:
+        tmp_file.unlink(missing_ok=True)